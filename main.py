@@ -2,6 +2,8 @@ from tqdm import tqdm
 import argparse
 
 from pipeline import PipelineJoint
+from utils.benchmark_train import BENCHMARK_MODES, run_benchmark
+from utils.frame_store import build_frame_store, build_test_cache
 from utils.stats_utils_joint import calc_comparison_baseline, calc_avg_categories, generate_average_file, basic_stats
 
 from models.joint_nvidia import EncoderNvidia, DecoderNvidia, RegressorNvidia
@@ -74,14 +76,37 @@ def main(args):
         pl = PipelineJoint(args) # Training the AE on the batch method, but testing on the original pipeline b/c it's the same testing pipeline
         pl.train()
 
+    if args.run_mode == "build_frame_store":
+        # One time ingest of the training frames into the memmap used by --frame_store true
+        build_frame_store(args.data_dir, args.dataset, "train", args.img_dim)
+
+    if args.run_mode == "build_test_cache":
+        # Renders the 75 single perturbation test sets once for --test_cache true
+        aug_list = get_aug_list('./aug_list_all.txt')
+        build_test_cache(args.data_dir, args.dataset, args.seed, aug_list[1:76])
+
+    if args.run_mode == "benchmark":
+        # Training step throughput of args.model on synthetic inputs, no dataset needed
+        run_benchmark(args)
+
     if args.run_mode == "test_autojoin":
         aug_list = get_aug_list('./aug_list_all.txt')   
 
+        # The model and the test index are only loaded once for the whole benchmark
+        pl = PipelineJoint(args, "test", aug_list[0], 0)
+
         # Testing on the benchmark datasets: single, clean, combined, & unseen
         for i in tqdm(range(117)):
+            if args.test_fanout == "true" and 0 < i < 76:
+                # All 75 single perturbations are evaluated together, image by image
+                if i == 1:
+                    print(f"\n2-76 {aug_list[1]} ... {aug_list[75]}")
+                    pl.test_fanout(aug_list[1:76], "ours")
+                continue
+
             print(f"\n{i+1} {aug_list[i]}")
 
-            pl = PipelineJoint(args, "test", aug_list[i], i)
+            pl.set_test_perturb(aug_list[i], i)
             pl.test_our_approach()
         
         calc_all_avgs_categories()
@@ -89,20 +114,31 @@ def main(args):
     if args.run_mode == "test_others":
         aug_list = get_aug_list('./aug_list_all.txt')   
 
+        pl = PipelineJoint(args, "test", aug_list[0], 0)
+
         # Testing on the benchmark datasets: single, clean, combined, & unseen
         for i in tqdm(range(117)):
+            if args.test_fanout == "true" and 0 < i < 76:
+                # All 75 single perturbations are evaluated together, image by image
+                if i == 1:
+                    print(f"\n2-76 {aug_list[1]} ... {aug_list[75]}")
+                    pl.test_fanout(aug_list[1:76], "other")
+                continue
+
             print(f"\n{i+1} {aug_list[i]}")
 
-            pl = PipelineJoint(args, "test", aug_list[i], i)
+            pl.set_test_perturb(aug_list[i], i)
             pl.test_other()
 
     if args.run_mode == "sanity_check":
 
+        pl = PipelineJoint(args, "test", "random")
+
         # Doing n number of random restarts
         for i in tqdm(range(100)):
             print(f"Random Restart: {i+1}")
 
-            pl = PipelineJoint(args, "test", "random")
+            pl.set_test_perturb("random")
             pl.test_our_approach()
         
         aug_techs = ["ours"]
@@ -129,9 +165,40 @@ if __name__ == "__main__":
     parser.add_argument("--model", default="nvidia", choices=["nvidia", "resnet50", "vit"])
     parser.add_argument("--num_classes", type=int, default=1)
     parser.add_argument("--load", default="false")
-    parser.add_argument("--run_mode", default="train", choices=["train", "test_autojoin", "test_others", "sanity_check"])
+    parser.add_argument("--run_mode", default="train", choices=["train", "test_autojoin", "test_others", "sanity_check", "build_frame_store", "build_test_cache", "benchmark"])
     parser.add_argument("--img_dim", type=int, default=None)
     parser.add_argument("--lambda1", type=int, default=10)
     parser.add_argument("--lambda2", type=int, default=1)
+    parser.add_argument("--test_batch_size", type=int, default=64, help="Size of testing batch")
+    parser.add_argument("--test_num_workers", type=int, default=8, help="Number of dataloader workers used when testing")
+    parser.add_argument("--test_fanout", default="false", help="Decode each clean test image once and evaluate all single perturbations on it together")
+    parser.add_argument("--pin_memory", default="false", help="Use pinned memory for the test dataloader")
+    parser.add_argument("--prefetch_batches", type=int, default=0, help="Number of training batches prepared and moved to the device ahead of the step by a background thread, 0 to prepare them in the step")
+    parser.add_argument("--persistent_workers", default="false", help="Keep the training and validation dataloader workers alive across epochs")
+    parser.add_argument("--profile", default="false", help="Profile a window of training steps with torch.profiler, writing a Chrome trace and op tables to logs_dir")
+    parser.add_argument("--profile_skip", type=int, default=10, help="Training steps run before the profiler starts")
+    parser.add_argument("--profile_warmup", type=int, default=2, help="Profiler warmup steps, not recorded")
+    parser.add_argument("--profile_active", type=int, default=5, help="Training steps recorded by the profiler")
+    parser.add_argument("--profile_top_k", type=int, default=30, help="Number of ops in the profiler tables")
+    parser.add_argument("--telemetry", default="false", help="Sample the memory, CPU, threads, file descriptors and dataloader queues of training into resources.csv in logs_dir")
+    parser.add_argument("--telemetry_interval", type=float, default=5., help="Seconds between two telemetry samples")
+    parser.add_argument("--benchmark_batch_sizes", type=int, nargs="+", default=[32, 64, 128], help="Batch sizes timed by --run_mode benchmark")
+    parser.add_argument("--benchmark_threads", type=int, nargs="+", default=None, help="Thread counts timed by --run_mode benchmark, torch's default when not given")
+    parser.add_argument("--benchmark_modes", nargs="+", default=BENCHMARK_MODES, choices=BENCHMARK_MODES, help="Steps timed by --run_mode benchmark")
+    parser.add_argument("--benchmark_warmup", type=int, default=5, help="Untimed steps before each benchmark")
+    parser.add_argument("--benchmark_steps", type=int, default=20, help="Timed steps per benchmark")
+    parser.add_argument("--benchmark_json", default=None, help="File the benchmark results are written to, benchmark_<model>.json in logs_dir by default")
+    parser.add_argument("--worker_augs", default="false", help="Generate the training perturbations in the dataloader workers")
+    parser.add_argument("--blur_backend", default="exact", choices=["exact", "separable", "box"], help="Blur implementation used for the training perturbations")
+    parser.add_argument("--noise_backend", default="exact", choices=["exact", "bank"], help="Noise implementation used for the training perturbations")
+    parser.add_argument("--frame_store", default="false", help="Train from the pre-decoded frame store built by --run_mode build_frame_store")
+    parser.add_argument("--counter_rng", default="false", help="Draw the training perturbations from generators keyed by (seed, epoch, sample index), independent of the dataloader workers")
+    parser.add_argument("--test_cache", default="false", help="Test the single perturbations on the frames rendered by --run_mode build_test_cache")
+    parser.add_argument("--render_unseen", default="false", help="Render the combined and unseen test sets from the clean frames instead of reading their folders")
+    parser.add_argument("--perturb_cache", default="false", help="Cache the blur and distort outputs, keyed by the image content and the perturbation level")
+    parser.add_argument("--perturb_cache_ram_mb", type=int, default=256, help="Size of the in-memory tier of the perturbation cache, per process")
+    parser.add_argument("--perturb_cache_disk_mb", type=int, default=0, help="Size of the on-disk tier of the perturbation cache, 0 turns it off")
+    parser.add_argument("--perturb_cache_dir", default="perturb_cache/", help="Directory of the on-disk tier of the perturbation cache")
+    parser.add_argument("--combined_frac", type=float, default=0., help="Share of the training images given a combined perturbation instead of a single one")
 
     main(parser.parse_args())
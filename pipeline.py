@@ -3,20 +3,26 @@ import time
 import random
 import os
 import csv
+from functools import partial
 from sklearn.model_selection import train_test_split
 
 import torch
 import torchvision
 from torch import nn
 from torch.utils.data import DataLoader
+from torch.profiler import record_function
 import torchvision.transforms as transforms
 
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import numpy as np
 
-from utils.data_utils import TrainDriveDataset, ClassifyDataset,TestDriveDataset, TrainDriveDatasetPerturb
-from utils.generate_augs import generate_augmentations_batch
+from utils.data_utils import TrainDriveDataset, ClassifyDataset,TestDriveDataset, TrainDriveDatasetPerturb, TrainDriveDatasetMM, TestDriveDatasetFanout, AugmentCollate, RenderCollate, DevicePrefetcher
+from utils.frame_store import frame_store_exists, load_frame_store, load_test_cache, IMG_HEIGHT, IMG_WIDTH
+from utils.generate_augs import generate_augmentations_batch, set_blur_backend, precompute_blur_levels, set_noise_backend, get_noise_bank, set_perturb_cache, set_combined_frac, get_scratch
+from utils.perturb_cache import PerturbCache
+from utils.stage_timer import StageTimer
+from utils.resource_monitor import ResourceSampler
 from utils.error_metrics import mae, ma, rmse, acc
 from utils.sam import SAM
 
@@ -62,13 +68,79 @@ class PipelineJoint:
             self.lambda1 = self.args.lambda1
             self.lambda2 = self.args.lambda2
 
+            # When true, the perturbations are generated by the dataloader workers (see AugmentCollate)
+            self.worker_augs = self.args.worker_augs == "true"
+
+            # When true, the dataloader workers are kept alive across epochs and validation instead of being restarted
+            self.persistent_workers = self.args.persistent_workers == "true"
+
+            # Number of batches prepared and moved to the device ahead of the training step (see DevicePrefetcher), 0 for none
+            self.prefetch_batches = self.args.prefetch_batches
+
+            # When true, the perturbations of a sample are drawn from a generator keyed by (seed, epoch, sample index)
+            self.counter_rng = self.args.counter_rng == "true"
+            augment_seed = self.args.seed if self.counter_rng else None
+
+            # Only training uses the selected blur backend, testing always blurs with the exact one.
+            # Set before the dataloader workers are started so they inherit it
+            set_blur_backend(self.args.blur_backend)
+            precompute_blur_levels(range(7, 109, 2))
+
+            # Same goes for the noise backend. The bank is filled here, after seeding, so the workers share one buffer
+            set_noise_backend(self.args.noise_backend)
+            if self.args.noise_backend == "bank":
+                get_noise_bank()
+
+            # Blur and distort outputs reused across epochs (and runs, with a disk tier)
+            self.perturb_cache = get_perturb_cache(self.args)
+            set_perturb_cache(self.perturb_cache)
+
+            set_combined_frac(self.args.combined_frac)
+
             print(f"HYPERPARAMETERS\n------------------------")
             print(f"Train batch_size: {self.batch_size}")
             print(f"Learning rate: {self.lr}")
             print(f"Training Epochs: {self.train_epochs}\n")
 
             
-            if self.args.dataset_type == "driving":
+            if self.args.dataset_type == "driving" and self.args.frame_store == "true":
+                # This is for loading the data from the pre-decoded frame store (see utils/frame_store.py)
+                if not frame_store_exists(self.args.data_dir, self.args.dataset, "train"):
+                    raise FileNotFoundError(f"No frame store found for {self.args.dataset}, build it with --run_mode build_frame_store")
+
+                frames, y = load_frame_store(self.args.data_dir, self.args.dataset, "train")
+
+                # The frames were resized when the store was built, so it has to have been built with the same --img_dim
+                expected_size = (self.args.img_dim, self.args.img_dim) if self.args.img_dim else (IMG_HEIGHT, IMG_WIDTH)
+                if tuple(frames.shape[1:3]) != expected_size:
+                    raise ValueError(f"The frame store for {self.args.dataset} holds {frames.shape[1]}x{frames.shape[2]} frames but "
+                                     f"{expected_size[0]}x{expected_size[1]} are expected, rebuild it with --run_mode build_frame_store "
+                                     f"and the same --img_dim as training")
+
+                # Splitting the indices the same way the names are split below so the train/val split is unchanged
+                indices = np.arange(len(y))
+                idx_train, idx_val = train_test_split(indices, test_size=0.1, random_state=42)
+
+                self.train_dataset = TrainDriveDatasetMM(args, frames, y, idx_train)
+                self.val_dataset = TrainDriveDatasetMM(args, frames, y, idx_val)
+
+                self.train_dataloader = DataLoader(dataset=self.train_dataset,
+                                                    batch_size=self.batch_size,
+                                                    shuffle=True,
+                                                    collate_fn=AugmentCollate(self.train_dataset, augment_seed) if self.worker_augs else None,
+                                                    num_workers=8,
+                                                    prefetch_factor=8,
+                                                    persistent_workers=self.persistent_workers)
+
+                self.val_dataloader = DataLoader(dataset=self.val_dataset,
+                                                    batch_size=self.batch_size,
+                                                    shuffle=True,
+                                                    collate_fn=None,
+                                                    num_workers=8,
+                                                    prefetch_factor=8,
+                                                    persistent_workers=self.persistent_workers)
+
+            elif self.args.dataset_type == "driving":
                 # This is for loading the data from image files (like png/jpg/etc.)
                 label_path_train = os.path.join(self.args.data_dir, f"{self.args.dataset}", "labels_train.csv")
 
@@ -93,21 +165,23 @@ class PipelineJoint:
                 self.train_dataloader = DataLoader(dataset=self.train_dataset,
                                                     batch_size=self.batch_size,
                                                     shuffle=True,
-                                                    collate_fn=None,
+                                                    collate_fn=AugmentCollate(self.train_dataset, augment_seed) if self.worker_augs else None,
                                                     num_workers=8,
-                                                    prefetch_factor=8)
+                                                    prefetch_factor=8,
+                                                    persistent_workers=self.persistent_workers)
 
                 self.val_dataloader = DataLoader(dataset=self.val_dataset,
                                                     batch_size=self.batch_size,
                                                     shuffle=True,
                                                     collate_fn=None,
                                                     num_workers=8,
-                                                    prefetch_factor=8)
+                                                    prefetch_factor=8,
+                                                    persistent_workers=self.persistent_workers)
             
             elif self.args.dataset_type == "cifar10":
         
                 self.train_dataset = torchvision.datasets.CIFAR10(root='./data', train=True,
-                                                        download=True, transform=transforms.ToTensor())
+                                                        download=True, transform=np.array) # uint8 HWC like the driving datasets
                 
                 self.train_dataset, self.val_dataset = torch.utils.data.random_split(self.train_dataset, [0.9, 0.1])
 
@@ -115,42 +189,44 @@ class PipelineJoint:
                 self.val_dataset = ClassifyDataset(self.val_dataset)
 
                 self.train_dataloader = torch.utils.data.DataLoader(self.train_dataset, batch_size=self.batch_size,
-                                                        shuffle=True, num_workers=8)
+                                                        shuffle=True, num_workers=8,
+                                                        collate_fn=AugmentCollate(self.train_dataset, augment_seed) if self.worker_augs else None,
+                                                        persistent_workers=self.persistent_workers)
                 
                 self.val_dataloader = torch.utils.data.DataLoader(self.val_dataset, batch_size=self.batch_size,
-                                                        shuffle=True, num_workers=8)        
+                                                        shuffle=True, num_workers=8,
+                                                        persistent_workers=self.persistent_workers)        
 
-            if self.args.model == "resnet50":
-                self.encoder = EncoderRN50([3, 4, 6, 3], 3, self.args.num_classes).to(self.device)
-                self.regressor = RegressorRN50([3, 4, 6, 3], 3, self.args.num_classes).to(self.device)
-                self.decoder = DecoderRN50().to(self.device)
-
-            elif self.args.model == "nvidia":                
-                self.encoder = EncoderNvidia(self.args.num_classes).to(self.device)
-                self.regressor = RegressorNvidia(self.args.num_classes).to(self.device)
-                self.decoder = DecoderNvidia(num_classes=self.args.num_classes).to(self.device)
-            
-            elif self.args.model == "vit":
-                self.encoder = EncoderViT(self.args).to(self.device)
-                self.regressor = RegressorViT().to(self.device)
-                self.decoder = DecoderViT(self.args).to(self.device)
+            # The counter-based generators need to know which samples are in a batch
+            if self.counter_rng:
+                self.train_dataset.return_index = True
+
+            self.encoder, self.decoder, self.regressor = get_joint_models(self.args, self.device)
 
             print(self.encoder)
             print(self.regressor)
             print(self.decoder)
 
-            self.recon_loss = nn.MSELoss()
-
-            if self.args.num_classes == 1:
-                self.regr_loss = nn.L1Loss()
-            elif self.args.num_classes == 10:
-                self.regr_loss = nn.CrossEntropyLoss()
+            self.recon_loss, self.regr_loss = get_joint_losses(self.args)
 
             self.params = list(self.encoder.parameters()) + list(self.regressor.parameters()) + list(self.decoder.parameters())
             self.optimizer = torch.optim.Adam(self.params, lr=self.lr)
             self.load_epoch = 0
             self.best_loss = float('inf')
 
+            # Wall time per stage of every epoch, written to train_stages.jsonl
+            self.stage_timer = StageTimer()
+
+            # torch.profiler over a window of training steps when --profile is true, None otherwise
+            self.profiler = get_profiler(self.args, self.device)
+
+            # Memory, CPU and dataloader queue telemetry written to resources.csv when --telemetry is true
+            self.loader_iter = None
+            self.prefetcher = None
+            self.resource_sampler = None
+            if self.args.telemetry == "true":
+                self.resource_sampler = ResourceSampler(self.args.logs_dir, self.args.telemetry_interval, self.get_loader_depths)
+
             self.train_loss_collector = np.zeros(self.train_epochs)
             self.train_recon_loss_collector = np.zeros(self.train_epochs)
             self.train_reg_loss_collector = np.zeros(self.train_epochs)
@@ -185,8 +261,15 @@ class PipelineJoint:
             
 
         else:
-            self.test_perturb = test_perturb
-            self.test_num = test_num
+            # The test index and the models are only loaded once, set_test_perturb() then swaps the
+            # perturbation being evaluated so the whole benchmark can run off of one PipelineJoint
+            self.test_encoder = None
+            self.test_regressor = None
+            self.test_other_method = None
+
+            # Testing always blurs with the exact backend, so its entries can be shared with other test runs
+            self.perturb_cache = get_perturb_cache(self.args)
+            set_perturb_cache(self.perturb_cache)
 
             # if self.test_perturb == "random":
             #     np.random.seed()
@@ -212,14 +295,16 @@ class PipelineJoint:
                         x_test.append(str(row[0][:-4]))
                         y_test.append(float(row[-1]))
             
-                x_test = np.array(x_test)
-                y_test = np.array(y_test)
+                self.x_test = np.array(x_test)
+                self.y_test = np.array(y_test)
 
-                self.test_dataset = TestDriveDataset(self.args, x_test, y_test, self.test_perturb, self.test_num)
+                # Pre-rendered single perturbations, built with --run_mode build_test_cache
+                self.test_cache = None
+                if self.args.test_cache == "true":
+                    self.test_cache = load_test_cache(self.args.data_dir, self.args.dataset, self.args.seed)
 
-                self.test_dataloader = DataLoader(dataset=self.test_dataset, 
-                                                    batch_size=1, 
-                                                    shuffle=False)
+                    if self.test_cache is None:
+                        print("No test cache for this seed and perturbation code, rendering the single perturbations on the fly")
             
             elif self.args.dataset_type == "cifar10":
                 self.test_dataset = torchvision.datasets.CIFAR10(root='./data', train=False,
@@ -229,169 +314,250 @@ class PipelineJoint:
                                                                     batch_size=1,
                                                                     shuffle=False)
 
+            self.set_test_perturb(test_perturb, test_num)
+
+    # Function that switches the perturbation being tested without reloading the test index or the models
+    def set_test_perturb(self, test_perturb, test_num=0):
+        self.test_perturb = test_perturb
+        self.test_num = test_num
+
+        # Re-seeding so every perturbation sees the same random draws as a freshly built PipelineJoint
+        random.seed(self.args.seed)
+        np.random.seed(self.args.seed)
+        torch.manual_seed(self.args.seed)
+
+        if self.args.dataset_type == "driving":
+            cached_frames = None
+            if self.test_cache is not None and 0 < self.test_num < 76:
+                cached_frames = self.test_cache.get(self.test_perturb)
+
+            self.test_dataset = TestDriveDataset(self.args, self.x_test, self.y_test, self.test_perturb, self.test_num, cached_frames)
+
+            # Perturbations that draw random numbers are loaded in the main process, in order, so they
+            # consume the seeded RNG exactly like the batch_size=1 loader did and the results don't change
+            num_workers = self.args.test_num_workers if self.test_dataset.is_deterministic() else 0
+
+            self.test_dataloader = DataLoader(dataset=self.test_dataset, 
+                                                batch_size=self.args.test_batch_size, 
+                                                shuffle=False,
+                                                num_workers=num_workers,
+                                                pin_memory=self.args.pin_memory == "true",
+                                                collate_fn=RenderCollate(self.test_dataset) if self.test_dataset.render else None)
+
     # Function that trains the model while validating the model at the same time
     def train(self):
         print("\nStarted Training\n")
 
-        for ep in range(self.load_epoch, self.train_epochs):
-            self.encoder.train()
-            self.decoder.train()
-            self.regressor.train()
+        if self.profiler is not None:
+            self.profiler.start()
+
+        if self.resource_sampler is not None:
+            self.resource_sampler.start()
 
-            if ep==0:
-                with open(f'{self.args.logs_dir}/encoder_init_weights.txt', 'w') as f:
-                  for param in self.encoder.parameters():
-                    f.write("%s\n" % param.data)
+        # Stopped in the finally, so a run that fails still gets its resources summary
+        try:
+            for ep in range(self.load_epoch, self.train_epochs):
+                self.encoder.train()
+                self.decoder.train()
+                self.regressor.train()
+
+                if ep==0:
+                    with open(f'{self.args.logs_dir}/encoder_init_weights.txt', 'w') as f:
+                      for param in self.encoder.parameters():
+                        f.write("%s\n" % param.data)
                 
-                with open(f'{self.args.logs_dir}/decoder_init_weights.txt', 'w') as f:
-                  for param in self.decoder.parameters():
-                    f.write("%s\n" % param.data)
+                    with open(f'{self.args.logs_dir}/decoder_init_weights.txt', 'w') as f:
+                      for param in self.decoder.parameters():
+                        f.write("%s\n" % param.data)
                 
-                with open(f'{self.args.logs_dir}/regressor_init_weights.txt', 'w') as f:
-                  for param in self.regressor.parameters():
-                    f.write("%s\n" % param.data)
+                    with open(f'{self.args.logs_dir}/regressor_init_weights.txt', 'w') as f:
+                      for param in self.regressor.parameters():
+                        f.write("%s\n" % param.data)
 
-            start_time = time.time()
+                start_time = time.time()
+                self.stage_timer.reset()
 
-            train_batch_loss = 0
-            train_batch_recon_loss = 0
-            train_batch_reg_loss = 0
+                if self.resource_sampler is not None:
+                    self.resource_sampler.epoch = ep+1
 
-            # Below two arrays are used for calculing Mean Accuracy during training
-            gt_train = [] 
-            preds_train = []
+                # Read by the dataloader workers when the perturbations use the counter-based generators
+                self.train_dataset.set_epoch(ep)
 
-            for bi, data in enumerate(tqdm(self.train_dataloader)):
-                if not isinstance(self.train_dataset, TrainDriveDatasetPerturb):
-                    clean_batch, labels = data
+                train_batch_loss = 0
+                train_batch_recon_loss = 0
+                train_batch_reg_loss = 0
 
-                    clean_batch = clean_batch.numpy()
-                    clean_batch = clean_batch * 255.
-                    clean_batch = np.uint8(clean_batch) # Images need to be uint8 for cv2 when doing the augmentations
-                    clean_batch = np.moveaxis(clean_batch, 1, -1)
-                    
-                    noise_batch = generate_augmentations_batch(clean_batch, self.train_dataset.get_curr_max())
-                    
-                    noise_batch = noise_batch / 255.
-                    clean_batch = clean_batch / 255.
-
-                    clean_batch = np.moveaxis(clean_batch, -1, 1)
-                    noise_batch = torch.tensor(noise_batch, dtype=torch.float32)
-                    clean_batch = torch.tensor(clean_batch, dtype=torch.float32)   
+                # Below two arrays are used for calculing Mean Accuracy during training
+                gt_train = [] 
+                preds_train = []
 
+                # The batches are either prepared here, step by step, or ahead of time by the prefetcher
+                if self.prefetch_batches > 0:
+                    train_batches = self.prefetcher = DevicePrefetcher(self.train_dataloader, self.device, partial(self.prepare_train_batch, ep=ep), self.prefetch_batches)
                 else:
-                    clean_batch, noise_batch, labels = data
+                    train_batches = self.loader_iter = iter(self.train_dataloader)
 
-                gt_train.extend(labels.numpy())
+                timer = self.stage_timer
+                wait_start = time.perf_counter()
 
-                if self.args.num_classes == 1:
-                    labels = torch.unsqueeze(labels, 1)                    
+                for bi, data in enumerate(tqdm(train_batches, total=len(self.train_dataloader))):
+                    # Time spent waiting on the dataloader (or the prefetcher) for this batch
+                    timer.add("data_wait", time.perf_counter() - wait_start)
 
-                noise_batch, clean_batch, labels = noise_batch.to(self.device), clean_batch.to(self.device), labels.to(self.device)
+                    if self.prefetch_batches == 0:
+                        data = self.prepare_train_batch(data, 0, ep)
 
-                # Passing it through model
-                z = self.encoder(noise_batch)
+                    clean_batch, noise_batch, labels, gt_batch = data
+                    gt_train.extend(gt_batch)
 
-                recon_batch = self.decoder(z)
-                sa_batch = self.regressor(z)
+                    if self.args.num_classes == 1:
+                        labels = torch.unsqueeze(labels, 1)                    
 
-                recon_loss = self.recon_loss(recon_batch, clean_batch)
-                regr_loss = self.regr_loss(sa_batch, labels)
+                    # Both batches are moved as uint8 and converted to float on the device
+                    with timer.stage("transfer"):
+                        noise_batch = to_float_batch(noise_batch, self.device)
+                        clean_batch = to_float_batch(clean_batch, self.device, channels_last=True)
+                        labels = labels.to(self.device)
 
-                loss = (self.lambda1 * recon_loss) + (self.lambda2 * regr_loss) 
+                    # Passing it through model
+                    with timer.stage("forward"):
+                        with record_function("encoder"):
+                            z = self.encoder(noise_batch)
 
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                        with record_function("decoder"):
+                            recon_batch = self.decoder(z)
+                        with record_function("regressor"):
+                            sa_batch = self.regressor(z)
 
-                train_batch_loss += loss.item()
-                train_batch_recon_loss += (self.lambda1 * recon_loss.item())
-                train_batch_reg_loss += (self.lambda2 * regr_loss.item())
+                        recon_loss = self.recon_loss(recon_batch, clean_batch)
+                        regr_loss = self.regr_loss(sa_batch, labels)
 
-                preds_train.extend(sa_batch.cpu().detach().numpy())
-            
-            avg_train_batch_loss = round(train_batch_loss / len(self.train_dataloader), 3)
-            avg_train_batch_recon_loss = round(train_batch_recon_loss / len(self.train_dataloader), 3)
-            avg_train_batch_reg_loss = round(train_batch_reg_loss / len(self.train_dataloader), 3)
-
-            if self.args.num_classes == 1:
-                ma_train = ma(preds_train, gt_train)
-            elif self.args.num_classes == 10:
-                ma_train = acc(preds_train, gt_train)
-
-            val_tuple = self.validate(self.val_dataloader)
-            avg_val_batch_loss = val_tuple[0]
-            ma_val = val_tuple[3]
-
-            # Saving epoch train and val loss to their respective collectors
-            self.train_loss_collector[ep] = avg_train_batch_loss
-            self.train_recon_loss_collector[ep] = avg_train_batch_recon_loss
-            self.train_reg_loss_collector[ep] = avg_train_batch_reg_loss
-
-            self.val_loss_collector[ep] = avg_val_batch_loss
-            self.val_recon_loss_collector[ep] = val_tuple[1]
-            self.val_reg_loss_collector[ep] = val_tuple[2]
-
-            end_time = time.time()
-            epoch_time = end_time - start_time
- 
-            print(f"Epoch: {ep+1}\t ATL: {avg_train_batch_loss:.3f}\t TMA: {ma_train:.2f}%\t AVL: {avg_val_batch_loss:.3f}\t VMA: {ma_val:.2f}%\t Time: {epoch_time:.3f}\t CV: {self.train_dataset.get_curr_max()}")
+                        loss = (self.lambda1 * recon_loss) + (self.lambda2 * regr_loss) 
 
-            with open(f'{self.args.logs_dir}/train_log_pp.txt', 'a') as train_log_pp:
-                train_log_pp.write(f"Epoch: {ep+1}\t ATL: {avg_train_batch_loss:.3f}\t TMA: {ma_train:.2f}\t AVL: {avg_val_batch_loss:.3f}\t VMA: {ma_val:.2f}%\t Time: {epoch_time:.3f} CV: {self.train_dataset.get_curr_max()}\n")
-            
-            with open(f'{self.args.logs_dir}/train_log.txt', 'a') as train_log:
-                train_log.write(f"{ep+1},{avg_train_batch_loss:.3f},{ma_train:.2f},{avg_val_batch_loss:.3f},{ma_val:.2f},{epoch_time:.3f},{self.train_dataset.get_curr_max()}\n")
+                    with timer.stage("backward"):
+                        self.optimizer.zero_grad()
+                        loss.backward()
+
+                    with timer.stage("optimizer"):
+                        self.optimizer.step()
+
+                    # Reading the losses and predictions back waits for the device
+                    with timer.stage("sync"):
+                        train_batch_loss += loss.item()
+                        train_batch_recon_loss += (self.lambda1 * recon_loss.item())
+                        train_batch_reg_loss += (self.lambda2 * regr_loss.item())
+
+                        preds_train.extend(sa_batch.cpu().detach().numpy())
+
+                    if self.profiler is not None:
+                        self.step_profiler()
+
+                    wait_start = time.perf_counter()
+
+                self.prefetcher = None
             
-            # Only saving the model if the average validation loss is better after another epoch
-            if avg_val_batch_loss < self.best_loss:
-                self.best_loss = avg_val_batch_loss
+                with timer.stage("metrics"):
+                    avg_train_batch_loss = round(train_batch_loss / len(self.train_dataloader), 3)
+                    avg_train_batch_recon_loss = round(train_batch_recon_loss / len(self.train_dataloader), 3)
+                    avg_train_batch_reg_loss = round(train_batch_reg_loss / len(self.train_dataloader), 3)
+
+                    if self.args.num_classes == 1:
+                        ma_train = ma(preds_train, gt_train)
+                    elif self.args.num_classes == 10:
+                        ma_train = acc(preds_train, gt_train)
+
+                val_tuple = self.validate(self.val_dataloader)
+                avg_val_batch_loss = val_tuple[0]
+                ma_val = val_tuple[3]
+
+                # Saving epoch train and val loss to their respective collectors
+                self.train_loss_collector[ep] = avg_train_batch_loss
+                self.train_recon_loss_collector[ep] = avg_train_batch_recon_loss
+                self.train_reg_loss_collector[ep] = avg_train_batch_reg_loss
+
+                self.val_loss_collector[ep] = avg_val_batch_loss
+                self.val_recon_loss_collector[ep] = val_tuple[1]
+                self.val_reg_loss_collector[ep] = val_tuple[2]
+
+                end_time = time.time()
+                epoch_time = end_time - start_time
+                log_start = time.perf_counter()
+ 
+                print(f"Epoch: {ep+1}\t ATL: {avg_train_batch_loss:.3f}\t TMA: {ma_train:.2f}%\t AVL: {avg_val_batch_loss:.3f}\t VMA: {ma_val:.2f}%\t Time: {epoch_time:.3f}\t CV: {self.train_dataset.get_curr_max()}")
+                if self.perturb_cache is not None:
+                    print(f"Perturbation cache: {self.perturb_cache.summary()}")
 
-                print("Saving new model")
                 with open(f'{self.args.logs_dir}/train_log_pp.txt', 'a') as train_log_pp:
-                    train_log_pp.write("Saving new model\n")
-
-                torch.save(self.encoder.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/encoder.pth')
-                torch.save(self.decoder.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/decoder.pth')
-                torch.save(self.regressor.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/regressor.pth')
+                    train_log_pp.write(f"Epoch: {ep+1}\t ATL: {avg_train_batch_loss:.3f}\t TMA: {ma_train:.2f}\t AVL: {avg_val_batch_loss:.3f}\t VMA: {ma_val:.2f}%\t Time: {epoch_time:.3f} CV: {self.train_dataset.get_curr_max()}\n")
+            
+                with open(f'{self.args.logs_dir}/train_log.txt', 'a') as train_log:
+                    train_log.write(f"{ep+1},{avg_train_batch_loss:.3f},{ma_train:.2f},{avg_val_batch_loss:.3f},{ma_val:.2f},{epoch_time:.3f},{self.train_dataset.get_curr_max()}\n")
 
-                torch.save({
-                    "encoder_state_dict": self.encoder.state_dict(),
-                    "decoder_state_dict": self.decoder.state_dict(),
-                    "regressor_state_dict": self.regressor.state_dict(),
-                    "optimizer_state_dict": self.optimizer.state_dict(),
-                    "load_epoch": ep+1,
-                    "best_loss": self.best_loss,
-                    "cv": self.train_dataset.get_curr_max(),
-                    "train_loss_collector": self.train_loss_collector,
-                    "train_recon_loss_collector": self.train_recon_loss_collector,
-                    "train_reg_loss_collector": self.train_reg_loss_collector,
-                    "val_loss_collector": self.val_loss_collector,
-                    "val_recon_loss_collector": self.val_recon_loss_collector,
-                    "val_reg_loss_collector": self.val_reg_loss_collector
-                }, f'{self.args.logs_dir}/{self.args.checkpoints_dir}/checkpoint_best_loss.pt')
-
-                if self.train_dataset.get_curr_max() < 0.99:
-                    self.train_dataset.increase_curr_max()
-                    self.val_dataset.increase_curr_max()
-                    print(f"Increasing the curriculum value to {self.train_dataset.get_curr_max()}")
+                timer.add("logging", time.perf_counter() - log_start)
+                checkpoint_start = time.perf_counter()
+            
+                # Only saving the model if the average validation loss is better after another epoch
+                if avg_val_batch_loss < self.best_loss:
+                    self.best_loss = avg_val_batch_loss
+
+                    print("Saving new model")
+                    with open(f'{self.args.logs_dir}/train_log_pp.txt', 'a') as train_log_pp:
+                        train_log_pp.write("Saving new model\n")
+
+                    torch.save(self.encoder.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/encoder.pth')
+                    torch.save(self.decoder.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/decoder.pth')
+                    torch.save(self.regressor.state_dict(), f'{self.args.logs_dir}/{self.args.trained_models_dir}/regressor.pth')
+
+                    torch.save({
+                        "encoder_state_dict": self.encoder.state_dict(),
+                        "decoder_state_dict": self.decoder.state_dict(),
+                        "regressor_state_dict": self.regressor.state_dict(),
+                        "optimizer_state_dict": self.optimizer.state_dict(),
+                        "load_epoch": ep+1,
+                        "best_loss": self.best_loss,
+                        "cv": self.train_dataset.get_curr_max(),
+                        "train_loss_collector": self.train_loss_collector,
+                        "train_recon_loss_collector": self.train_recon_loss_collector,
+                        "train_reg_loss_collector": self.train_reg_loss_collector,
+                        "val_loss_collector": self.val_loss_collector,
+                        "val_recon_loss_collector": self.val_recon_loss_collector,
+                        "val_reg_loss_collector": self.val_reg_loss_collector
+                    }, f'{self.args.logs_dir}/{self.args.checkpoints_dir}/checkpoint_best_loss.pt')
+
+                    if self.train_dataset.get_curr_max() < 0.99:
+                        self.train_dataset.increase_curr_max()
+                        self.val_dataset.increase_curr_max()
+                        print(f"Increasing the curriculum value to {self.train_dataset.get_curr_max()}")
     
-            torch.save({
-                    "encoder_state_dict": self.encoder.state_dict(),
-                    "decoder_state_dict": self.decoder.state_dict(),
-                    "regressor_state_dict": self.regressor.state_dict(),
-                    "optimizer_state_dict": self.optimizer.state_dict(),
-                    "load_epoch": ep+1,
-                    "best_loss": self.best_loss,
-                    "cv": self.train_dataset.get_curr_max(),
-                    "train_loss_collector": self.train_loss_collector,
-                    "train_recon_loss_collector": self.train_recon_loss_collector,
-                    "train_reg_loss_collector": self.train_reg_loss_collector,
-                    "val_loss_collector": self.val_loss_collector,
-                    "val_recon_loss_collector": self.val_recon_loss_collector,
-                    "val_reg_loss_collector": self.val_reg_loss_collector
-                }, f'{self.args.logs_dir}/{self.args.checkpoints_dir}/checkpoint.pt')
- 
+                torch.save({
+                        "encoder_state_dict": self.encoder.state_dict(),
+                        "decoder_state_dict": self.decoder.state_dict(),
+                        "regressor_state_dict": self.regressor.state_dict(),
+                        "optimizer_state_dict": self.optimizer.state_dict(),
+                        "load_epoch": ep+1,
+                        "best_loss": self.best_loss,
+                        "cv": self.train_dataset.get_curr_max(),
+                        "train_loss_collector": self.train_loss_collector,
+                        "train_recon_loss_collector": self.train_recon_loss_collector,
+                        "train_reg_loss_collector": self.train_reg_loss_collector,
+                        "val_loss_collector": self.val_loss_collector,
+                        "val_recon_loss_collector": self.val_recon_loss_collector,
+                        "val_reg_loss_collector": self.val_reg_loss_collector
+                    }, f'{self.args.logs_dir}/{self.args.checkpoints_dir}/checkpoint.pt')
+
+                # The stages of the epoch, the checkpoint writes come after epoch_time was taken so they are on top of it
+                timer.add("checkpoint", time.perf_counter() - checkpoint_start)
+                timer.write(f'{self.args.logs_dir}/train_stages.jsonl', epoch=ep+1, epoch_time=round(epoch_time, 6),
+                            batches=len(self.train_dataloader), batch_size=self.batch_size, prefetch_batches=self.prefetch_batches)
+        finally:
+            if self.resource_sampler is not None:
+                self.resource_sampler.stop()
+
+        if self.profiler is not None:
+            print(f"Training ended before the profiled steps were done, {self.profiler.step_num} of {get_profile_steps(self.args)} steps ran")
+            self.profiler.stop()
+            self.profiler = None
+
         print("\nFinished Training!\n")
 
         # Plotting the decrease in training and validation loss and then saving that as a figure
@@ -436,8 +602,15 @@ class PipelineJoint:
         gt_val = []
         preds_val = []
 
+        timer = self.stage_timer
+
         with torch.no_grad():
-            for bi, data in enumerate(val_dataloader):
+            val_batches = self.loader_iter = iter(val_dataloader)
+            wait_start = time.perf_counter()
+
+            for bi, data in enumerate(val_batches):
+                timer.add("val_data_wait", time.perf_counter() - wait_start)
+
                 if not isinstance(self.train_dataset, TrainDriveDatasetPerturb):
                     clean_batch, labels = data
                 else:
@@ -448,25 +621,30 @@ class PipelineJoint:
                 if self.args.num_classes == 1:
                     labels = torch.unsqueeze(labels, 1)     
 
-                clean_batch, labels = clean_batch.to(self.device), labels.to(self.device)
+                with timer.stage("val_transfer"):
+                    clean_batch, labels = to_float_batch(clean_batch, self.device, channels_last=True), labels.to(self.device)
 
                 # Passing it through model
-                z = self.encoder(clean_batch)
+                with timer.stage("val_forward"):
+                    z = self.encoder(clean_batch)
 
-                recon_batch = self.decoder(z)
-                sa_batch = self.regressor(z)
-                
-                recon_loss = self.recon_loss(recon_batch, clean_batch)
-                regr_loss = self.regr_loss(sa_batch, labels)
+                    recon_batch = self.decoder(z)
+                    sa_batch = self.regressor(z)
+                    
+                    recon_loss = self.recon_loss(recon_batch, clean_batch)
+                    regr_loss = self.regr_loss(sa_batch, labels)
+
+                    loss = (self.lambda1 * recon_loss)  + (self.lambda2 * regr_loss)
+                    # loss = (self.lambda2 * regr_loss)
 
-                loss = (self.lambda1 * recon_loss)  + (self.lambda2 * regr_loss)
-                # loss = (self.lambda2 * regr_loss)
+                with timer.stage("val_sync"):
+                    val_batch_loss += loss.item()
+                    val_batch_recon_loss += (self.lambda1 * recon_loss.item())
+                    val_batch_reg_loss += (self.lambda2 * regr_loss.item())
 
-                val_batch_loss += loss.item()
-                val_batch_recon_loss += (self.lambda1 * recon_loss.item())
-                val_batch_reg_loss += (self.lambda2 * regr_loss.item())
+                    preds_val.extend(sa_batch.cpu().detach().numpy())
 
-                preds_val.extend(sa_batch.cpu().detach().numpy())
+                wait_start = time.perf_counter()
 
         
         avg_val_batch_loss = round(val_batch_loss / len(val_dataloader), 3)
@@ -480,10 +658,76 @@ class PipelineJoint:
 
         return (avg_val_batch_loss, avg_val_batch_recon_loss, avg_val_batch_reg_loss, ma_val)
 
+    def get_loader_depths(self):
+        '''
+            Queue depths of the dataloader being iterated, read from the resource sampler's thread: the batches
+            requested from the workers and not taken yet, how many of those are ready and, with the prefetcher,
+            the batches staged for the step. These read private DataLoader iterator attributes.
+        '''
+
+        depths = {}
+        prefetcher = self.prefetcher
+        loader_iter = prefetcher.loader_iter if prefetcher is not None else self.loader_iter
+
+        if loader_iter is not None and hasattr(loader_iter, "_tasks_outstanding"):
+            depths["loader_outstanding"] = loader_iter._tasks_outstanding
+
+            try:
+                depths["loader_ready"] = loader_iter._data_queue.qsize()
+            except NotImplementedError: # macOS
+                pass
+
+        if prefetcher is not None:
+            depths["prefetch_ready"] = prefetcher.queue_depth()
+
+        return depths
+
+    def step_profiler(self):
+        self.profiler.step()
+
+        # Once the window is recorded (and exported by export_profile) the profiler is dropped so the rest of training runs without it
+        if self.profiler.step_num >= get_profile_steps(self.args):
+            self.profiler.stop()
+            self.profiler = None
+            print(f"\nProfiled steps written to {self.args.logs_dir}")
+
+    def prepare_train_batch(self, data, slot, ep):
+        '''
+            Returns the clean batch, the perturbed batch and the labels of a training step, still uint8 and on
+            the host, along with the labels as numpy for the metrics. slot picks the output buffer of the
+            perturbations, so the prefetcher can have several batches in flight.
+        '''
+
+        if not isinstance(self.train_dataset, TrainDriveDatasetPerturb) and not self.worker_augs:
+            if self.counter_rng:
+                clean_batch, labels, indices = data
+                sample_keys = (self.args.seed, ep, indices.numpy())
+            else:
+                clean_batch, labels = data
+                sample_keys = None
+
+            # The output buffer is reused between batches, it is copied by the conversion in the training step.
+            # With the prefetcher this runs in its thread, so "augment" overlaps the other stages
+            with self.stage_timer.stage("augment"):
+                images = clean_batch.numpy()
+                out = get_scratch(f"augment_out_{slot}", (images.shape[0], images.shape[3], images.shape[1], images.shape[2]))
+                noise_batch = torch.from_numpy(generate_augmentations_batch(images, self.train_dataset.get_curr_max(), sample_keys, out))
+
+        else:
+            clean_batch, noise_batch, labels = data
+
+        return clean_batch, noise_batch, labels, labels.numpy()
+
+    def load_other(self):
+        if self.test_other_method is None:
+            self.test_other_method = Nvidia().to(self.device)
+            self.test_other_method.load_state_dict(torch.load('./saved_models/standard1.pth'))
+            self.test_other_method.eval()
+
+        return self.test_other_method
+
     def test_other(self):
-        other_method = Nvidia().to(self.device)
-        other_method.load_state_dict(torch.load('./saved_models/standard1.pth'))
-        other_method.eval()
+        other_method = self.load_other()
 
         print("Started Testing")
 
@@ -493,12 +737,13 @@ class PipelineJoint:
         with torch.no_grad():
             for batch, data in enumerate(tqdm(self.test_dataloader)):
                 img_batch, labels = data
-                img_batch, labels = img_batch.to(self.device), labels.to(self.device)
+                img_batch = img_batch.to(self.device, non_blocking=True)
     
                 output, _ = other_method(img_batch)
-                preds_test.append(np.squeeze(output.cpu().detach().clone().numpy()))
 
-                gt_test.append(np.squeeze(labels.cpu().detach().clone().numpy()))
+                # Flattening so batches of any size are collected in order, one value per image
+                preds_test.extend(output.reshape(-1).cpu().numpy())
+                gt_test.extend(labels.reshape(-1).numpy())
         
         print("\nFinished Testing")
 
@@ -523,22 +768,34 @@ class PipelineJoint:
         
         print("Finished Writing Results to Logs\n") 
 
+        if self.perturb_cache is not None:
+            print(f"Perturbation cache: {self.perturb_cache.summary()}")
+
+    def load_our_approach(self):
+        if self.test_encoder is None:
+            if self.args.model == "resnet50":
+                encoder = EncoderRN50([3, 4, 6, 3], 3, 1).to(self.device)
+                regressor = RegressorRN50([3, 4, 6, 3], 3, 1).to(self.device)
+            elif self.args.model == "nvidia":
+                encoder = EncoderNvidia().to(self.device)
+                regressor = RegressorNvidia().to(self.device)
+            elif self.args.model == "vit":
+                encoder = EncoderViT(self.args).to(self.device)
+                regressor = RegressorViT().to(self.device)
+
+            encoder.load_state_dict(torch.load('./results/trained_models/encoder.pth'))
+            encoder.eval()
+
+            regressor.load_state_dict(torch.load('./results/trained_models/regressor.pth'))
+            regressor.eval()
+
+            self.test_encoder = encoder
+            self.test_regressor = regressor
+
+        return self.test_encoder, self.test_regressor
+
     def test_our_approach(self):
-        if self.args.model == "resnet":
-            encoder = EncoderRN50([3, 4, 6, 3], 3, 1).to(self.device)
-            regressor = RegressorRN50([3, 4, 6, 3], 3, 1).to(self.device)
-        elif self.args.model == "nvidia":
-            encoder = EncoderNvidia().to(self.device)
-            regressor = RegressorNvidia().to(self.device)
-        elif self.args.model == "vit":
-            encoder = EncoderViT(self.args).to(self.device)
-            regressor = RegressorViT().to(self.device)
-
-        encoder.load_state_dict(torch.load('./results/trained_models/encoder.pth'))
-        encoder.eval()
-
-        regressor.load_state_dict(torch.load('./results/trained_models/regressor.pth'))
-        regressor.eval()
+        encoder, regressor = self.load_our_approach()
 
         print("Started Testing")
 
@@ -548,12 +805,13 @@ class PipelineJoint:
         with torch.no_grad():
             for batch, data in enumerate(tqdm(self.test_dataloader)):
                 img_batch, labels = data
-                img_batch, labels = img_batch.to(self.device), labels.to(self.device)
+                img_batch = img_batch.to(self.device, non_blocking=True)
 
-                output = torch.squeeze(regressor(encoder(img_batch)))
+                output = regressor(encoder(img_batch))
             
-                preds_test.append(output.cpu().detach().clone().numpy())
-                gt_test.append(np.squeeze(labels.cpu().detach().clone().numpy()))
+                # Flattening so batches of any size are collected in order, one value per image
+                preds_test.extend(output.reshape(-1).cpu().numpy())
+                gt_test.extend(labels.reshape(-1).numpy())
 
                 # fig, ax = plt.subplots(3,1, figsize=(8,8), dpi=100)
                 # ax[0].imshow(Image.fromarray(np.uint8(np.moveaxis(clean_batch_np, 0, -1))).convert('RGB'))
@@ -585,8 +843,134 @@ class PipelineJoint:
         
         print("Finished Writing Results to Logs\n") 
 
+        if self.perturb_cache is not None:
+            print(f"Perturbation cache: {self.perturb_cache.summary()}")
+
+    def test_fanout(self, test_perturbs, method="ours"):
+        '''
+            Image-major evaluation of the single perturbations. Every clean test image is decoded once,
+            all of test_perturbs are applied to it and the perturbed variants go through the model together.
+            The results are written in the order of test_perturbs, same as calling test_our_approach()
+            (or test_other()) once per perturbation. Noise is still seeded, but since the draws happen in a
+            different order than the per-perturbation loop, its results are not bit-identical to that loop.
+        '''
+
+        random.seed(self.args.seed)
+        np.random.seed(self.args.seed)
+        torch.manual_seed(self.args.seed)
+
+        if method == "ours":
+            encoder, regressor = self.load_our_approach()
+            predict = lambda img_batch: regressor(encoder(img_batch))
+            name = "ours1"
+        else:
+            other_method = self.load_other()
+            predict = lambda img_batch: other_method(img_batch)[0]
+            name = "shen1"
+
+        fanout_dataset = TestDriveDatasetFanout(self.args, self.x_test, self.y_test, test_perturbs)
+
+        # Every item already holds len(test_perturbs) images, so the batch size is divided between them
+        fanout_dataloader = DataLoader(dataset=fanout_dataset,
+                                        batch_size=max(1, self.args.test_batch_size // len(test_perturbs)),
+                                        shuffle=False,
+                                        num_workers=self.args.test_num_workers,
+                                        pin_memory=self.args.pin_memory == "true")
+
+        print("Started Testing")
+
+        preds_test = []
+        gt_test = []
+
+        with torch.no_grad():
+            for batch, data in enumerate(tqdm(fanout_dataloader)):
+                img_batch, labels = data
+                num_imgs, num_perturbs = img_batch.shape[:2]
+
+                img_batch = to_float_batch(img_batch.reshape(num_imgs * num_perturbs, *img_batch.shape[2:]), self.device)
+
+                output = predict(img_batch)
+
+                preds_test.append(output.reshape(num_imgs, num_perturbs).cpu().numpy())
+                gt_test.extend(labels.reshape(-1).numpy())
+
+        print("\nFinished Regression")
+
+        preds_test = np.concatenate(preds_test)
+        gt_test = np.array(gt_test)
+
+        print("Writing Results to Logs")
+        metric_list = [ma, rmse, mae]
+
+        for p in range(len(test_perturbs)):
+            results = []
+            calc_metrics(metric_list, results, name, preds_test[:, p], gt_test)
+
+            for i in range(len(results)):
+                current = results[i]
+                write_results(test_perturbs[p], current[0], current[1])
+
+        print("Finished Writing Results to Logs\n") 
+
+        if self.perturb_cache is not None:
+            print(f"Perturbation cache: {self.perturb_cache.summary()}")
+
 # HELPER FUNCTIONS
 
+def get_joint_models(args, device):
+    # The encoder, decoder and regressor of args.model, trained together by PipelineJoint
+    if args.model == "resnet50":
+        encoder = EncoderRN50([3, 4, 6, 3], 3, args.num_classes)
+        regressor = RegressorRN50([3, 4, 6, 3], 3, args.num_classes)
+        decoder = DecoderRN50()
+
+    elif args.model == "nvidia":
+        encoder = EncoderNvidia(args.num_classes)
+        regressor = RegressorNvidia(args.num_classes)
+        decoder = DecoderNvidia(num_classes=args.num_classes)
+
+    elif args.model == "vit":
+        encoder = EncoderViT(args)
+        regressor = RegressorViT()
+        decoder = DecoderViT(args)
+
+    return encoder.to(device), decoder.to(device), regressor.to(device)
+
+def get_joint_losses(args):
+    # The reconstruction loss, and the regression (or classification, for CIFAR-10) loss
+    if args.num_classes == 1:
+        regr_loss = nn.L1Loss()
+    elif args.num_classes == 10:
+        regr_loss = nn.CrossEntropyLoss()
+
+    return nn.MSELoss(), regr_loss
+
+def to_float_batch(batch, device, channels_last=False):
+    '''
+        Moves a uint8 (B, C, H, W) batch to device and converts it into the float (B, C, H, W) in [0, 1] that
+        ToTensor produces, in a single pass. With channels_last the batch is (B, H, W, C) and the same pass
+        transposes it. Batches that are already float are only moved.
+    '''
+
+    if batch.dtype != torch.uint8:
+        return batch.to(device)
+
+    # Moved while still uint8, a quarter of the bytes of the float batch
+    batch = batch.to(device, non_blocking=True)
+    if channels_last:
+        batch = batch.permute(0, 3, 1, 2)
+
+    return torch.div(batch, 255., out=torch.empty(batch.shape, dtype=torch.float32, device=device))
+
+def get_perturb_cache(args):
+    # The perturbation cache selected by the args, or None when it is off
+    if args.perturb_cache != "true":
+        return None
+
+    return PerturbCache(ram_bytes=args.perturb_cache_ram_mb << 20,
+                        disk_dir=args.perturb_cache_dir,
+                        disk_bytes=args.perturb_cache_disk_mb << 20)
+
 def get_aug_method(aug_method):
     word_array = aug_method.split('_')
     aug_method = ""
@@ -619,3 +1003,48 @@ def calc_metrics(metric_list, results, name, aug_results, truths):
         aug_metric_results = func(aug_results, truths)
 
         results.append((aug_metric_results, f"{name}_{func.__name__}"))
+
+def get_profile_steps(args):
+    # Steps until the profiled window is over
+    return args.profile_skip + args.profile_warmup + args.profile_active
+
+def get_profiler(args, device):
+    '''
+        torch.profiler over the training steps when --profile is true: --profile_skip steps are skipped, the
+        next --profile_warmup steps warm the profiler up and the --profile_active steps after those are
+        recorded, with op shapes and memory. export_profile writes the results to logs_dir. None when off.
+    '''
+
+    if args.profile != "true":
+        return None
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(activities=activities,
+                                    schedule=torch.profiler.schedule(skip_first=args.profile_skip, wait=0, warmup=args.profile_warmup,
+                                                                    active=args.profile_active, repeat=1),
+                                    on_trace_ready=partial(export_profile, args=args),
+                                    record_shapes=True,
+                                    profile_memory=True)
+
+def export_profile(prof, args):
+    # Chrome trace (open in chrome://tracing or Perfetto) and the top ops by self time, by shape and by memory
+    prof.export_chrome_trace(f'{args.logs_dir}/profile_trace.json')
+
+    sort_by = "self_cuda_time_total" if torch.profiler.ProfilerActivity.CUDA in prof.activities else "self_cpu_time_total"
+    top_k = args.profile_top_k
+
+    with open(f'{args.logs_dir}/profile_ops.txt', 'w') as f:
+        f.write(f"Model: {args.model}, batch size: {args.batch_size}, steps recorded: {args.profile_active} "
+                f"(after skipping {args.profile_skip} and warming up {args.profile_warmup})\n\n")
+
+        f.write(f"Top {top_k} ops by {sort_by}\n")
+        f.write(prof.key_averages().table(sort_by=sort_by, row_limit=top_k) + "\n\n")
+
+        f.write(f"Top {top_k} ops by {sort_by}, per input shape\n")
+        f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=top_k) + "\n\n")
+
+        f.write(f"Top {top_k} ops by self_cpu_memory_usage\n")
+        f.write(prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=top_k) + "\n")
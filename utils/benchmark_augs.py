@@ -0,0 +1,293 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from utils.generate_augs import DIST_LVL, BLUR_LVL, IMG_HEIGHT, IMG_WIDTH, BLUR_MAX_ERROR
+from utils.generate_augs import distort_image, get_undistort_maps, blur_image, precompute_blur_levels
+from utils.generate_augs import COMBINE_METHODS, TEST_RGB_HSV_LVL, PERTURBATIONS, BATCH_PERTURBATIONS, BLUR_BACKENDS, NOISE_BACKENDS
+from utils.generate_augs import generate_augmentations_batch, render_perturbation_batch, get_scratch, set_blur_backend, set_noise_backend
+import utils.generate_augs as generate_augs
+
+'''
+    Benchmarks for the perturbation kernels in utils/generate_augs.py. Run from the root of the repo:
+
+        python3 -m utils.benchmark_augs
+
+    The kernels suite checks that the optimized kernels give the same pixels as the references they replace
+    before timing them. The perturbations and batch suites time every training perturbation, every test
+    perturbation and generate_augmentations_batch, and --json writes all of the results to a file so runs
+    (e.g. of different backends) can be compared over time.
+'''
+
+def get_sample_images(num_imgs, height=IMG_HEIGHT, width=IMG_WIDTH, seed=0):
+    # Smoothed noise, so interpolation based kernels see something closer to a real frame than white noise
+    rng = np.random.default_rng(seed)
+    imgs = rng.integers(0, 256, size=(num_imgs, height, width, 3), dtype=np.uint8)
+
+    return np.asarray([cv2.GaussianBlur(img, (5, 5), 0) for img in imgs])
+
+def get_edge_case_images(height=IMG_HEIGHT, width=IMG_WIDTH):
+    # Images that are hard on approximate kernels: single bright pixels, a checkerboard and step edges
+    impulse = np.zeros((height, width, 3), dtype=np.uint8)
+    impulse[height//2, width//2] = 255
+    impulse[0, 0] = 255
+
+    checker = ((np.indices((height, width)).sum(axis=0) % 2) * 255).astype(np.uint8)
+    checker = np.dstack([checker]*3)
+
+    edges = np.zeros((height, width, 3), dtype=np.uint8)
+    edges[:, width//2:] = 255
+    edges[height//3:height//2] = 128
+
+    return np.asarray([impulse, checker, edges])
+
+def time_per_image(func, imgs, repeats=5):
+    # Best of the repeats, so one-off stalls don't end up in the result
+    best = float('inf')
+
+    for r in range(repeats):
+        start_time = time.perf_counter()
+        for img in imgs:
+            func(img)
+        best = min(best, (time.perf_counter() - start_time) / len(imgs))
+
+    return best
+
+def time_per_call(func, repeats=5):
+    # Best of the repeats, like time_per_image
+    best = float('inf')
+
+    for r in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+
+    return best
+
+def get_peak_alloc(func):
+    '''
+        Peak bytes allocated during one call of func, as seen by tracemalloc. numpy arrays are counted,
+        the buffers OpenCV allocates for its own outputs are not.
+    '''
+
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def reference_distort(image, distort_level):
+    K = np.eye(3)*1000
+    K[0,2] = image.shape[1]/2
+    K[1,2] = image.shape[0]/2
+    K[2,2] = 1
+
+    return cv2.undistort(image, K, np.array([distort_level,distort_level,0,0]))
+
+def check_distort(imgs, levels=range(1, 501)):
+    '''
+        Checks that the cached remap gives the same pixels as cv2.undistort for every level in levels.
+        Returns the largest absolute pixel difference seen, which should be 0.
+    '''
+
+    max_diff = 0
+
+    for distort_level in levels:
+        for img in imgs:
+            expected = reference_distort(img, distort_level)
+            actual = distort_image(img, distort_level)
+
+            max_diff = max(max_diff, int(np.abs(expected.astype(np.int16) - actual).max()))
+
+    return max_diff
+
+def check_blur(imgs, backend, levels=range(7, 109, 2)):
+    # Largest absolute pixel difference between the backend and cv2.GaussianBlur over every level in levels
+    max_diff = 0
+
+    for blur_level in levels:
+        for img in imgs:
+            expected = cv2.GaussianBlur(img, (blur_level, blur_level), 0)
+            actual = blur_image(img, blur_level, backend)
+
+            max_diff = max(max_diff, int(np.abs(expected.astype(np.int16) - actual).max()))
+
+    return max_diff
+
+def benchmark_blur(imgs):
+    precompute_blur_levels(BLUR_LVL)
+    results = []
+
+    for blur_level in BLUR_LVL:
+        times = [time_per_image(lambda img: blur_image(img, blur_level, backend), imgs) for backend in BLUR_BACKENDS]
+        results.append((blur_level, times))
+
+    return results
+
+def benchmark_distort(imgs):
+    results = []
+
+    for distort_level in DIST_LVL:
+        get_undistort_maps.cache_clear()
+
+        reference_time = time_per_image(lambda img: reference_distort(img, distort_level), imgs)
+        cached_time = time_per_image(lambda img: distort_image(img, distort_level), imgs)
+
+        results.append((distort_level, reference_time, cached_time))
+
+    return results
+
+def benchmark_perturbations(imgs, levels=TEST_RGB_HSV_LVL, repeats=3):
+    '''
+        Times each of the training perturbations (perturb_*) per image at each intensity in levels. The
+        kernels modify their input, so they are called on a copy, and the copy is part of the timing like
+        it is in training.
+    '''
+
+    results = []
+
+    for method in COMBINE_METHODS:
+        for level, dist_ratio in enumerate(levels, start=1):
+            np.random.seed(0)
+            seconds = time_per_image(lambda img: method(img.copy(), dist_ratio), imgs, repeats)
+
+            img = imgs[0].copy()
+            peak_alloc = get_peak_alloc(lambda: method(img, dist_ratio))
+
+            results.append({"name": method.__name__, "level": level, "dist_ratio": dist_ratio,
+                            "us_per_image": seconds*1e6, "images_per_s": 1/seconds, "peak_alloc_bytes": peak_alloc})
+
+    return results
+
+def benchmark_test_perturbations(imgs, repeats=3):
+    # Times every registered test perturbation, the single ones per image and the batched ones over all of imgs
+    results = []
+
+    for name, kernel in PERTURBATIONS.items():
+        np.random.seed(0)
+        seconds = time_per_image(lambda img: kernel(img.copy()), imgs, repeats)
+
+        img = imgs[0].copy()
+        peak_alloc = get_peak_alloc(lambda: kernel(img))
+
+        results.append({"name": name, "batched": False, "us_per_image": seconds*1e6, "images_per_s": 1/seconds,
+                        "peak_alloc_bytes": peak_alloc})
+
+    seeds = list(range(len(imgs)))
+    for name in BATCH_PERTURBATIONS:
+        seconds = time_per_call(lambda: render_perturbation_batch(imgs, name, seeds), repeats) / len(imgs)
+        peak_alloc = get_peak_alloc(lambda: render_perturbation_batch(imgs, name, seeds)) // len(imgs)
+
+        results.append({"name": name, "batched": True, "us_per_image": seconds*1e6, "images_per_s": 1/seconds,
+                        "peak_alloc_bytes": peak_alloc})
+
+    return results
+
+def benchmark_augmentations_batch(imgs, batch_sizes, curriculum_maxes, repeats=5):
+    '''
+        Times generate_augmentations_batch on batches cut from imgs (repeated if there are fewer images than
+        the batch size), writing into a reused output buffer like the training loop does. peak_alloc_bytes
+        is per batch.
+    '''
+
+    results = []
+
+    for batch_size in batch_sizes:
+        image_batch = imgs[np.arange(batch_size) % len(imgs)]
+        out = get_scratch("benchmark_out", (batch_size, image_batch.shape[3]) + image_batch.shape[1:3])
+
+        for curriculum_max in curriculum_maxes:
+            np.random.seed(0)
+            generate_augmentations_batch(image_batch, curriculum_max, out=out) # warms up the caches and scratch buffers
+            seconds = time_per_call(lambda: generate_augmentations_batch(image_batch, curriculum_max, out=out), repeats)
+            peak_alloc = get_peak_alloc(lambda: generate_augmentations_batch(image_batch, curriculum_max, out=out))
+
+            results.append({"batch_size": batch_size, "curriculum_max": curriculum_max, "ms_per_batch": seconds*1e3,
+                            "images_per_s": batch_size/seconds, "peak_alloc_bytes": peak_alloc})
+
+    return results
+
+def get_run_info(args):
+    # What a result depends on, written alongside it in the JSON output
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "numpy": np.__version__,
+            "opencv": cv2.__version__, "cv2_threads": cv2.getNumThreads(), "machine": platform.machine(),
+            "processor": platform.processor(), "blur_backend": generate_augs.blur_backend,
+            "noise_backend": generate_augs.noise_backend, "num_imgs": args.num_imgs, "height": args.height,
+            "width": args.width}
+
+def print_kernel_benchmarks(imgs, args):
+    max_diff = check_distort(imgs[:4])
+    print(f"distort: max pixel difference vs cv2.undistort over levels 1-500: {max_diff}")
+    assert max_diff == 0, "cached remap does not match cv2.undistort"
+
+    print(f"{'level':>8} {'undistort (us)':>16} {'cached remap (us)':>18} {'speedup':>8}")
+    for distort_level, reference_time, cached_time in benchmark_distort(imgs):
+        print(f"{distort_level:>8} {reference_time*1e6:>16.1f} {cached_time*1e6:>18.1f} {reference_time/cached_time:>7.2f}x")
+
+    check_imgs = np.concatenate([imgs[:4], get_edge_case_images(args.height, args.width)])
+    for backend in BLUR_BACKENDS:
+        max_diff = check_blur(check_imgs, backend)
+        print(f"\nblur ({backend}): max pixel difference vs cv2.GaussianBlur over levels 7-107: {max_diff} (bound {BLUR_MAX_ERROR[backend]})")
+        assert max_diff <= BLUR_MAX_ERROR[backend], f"{backend} blur is outside of its error bound"
+
+    print(f"{'level':>8}" + "".join(f"{backend + ' (us)':>18}" for backend in BLUR_BACKENDS))
+    for blur_level, times in benchmark_blur(imgs):
+        print(f"{blur_level:>8}" + "".join(f"{t*1e6:>18.1f}" for t in times))
+
+def print_results(title, results, columns):
+    print(f"\n{title}")
+    print("".join(f"{column:>20}" for column in columns))
+
+    for result in results:
+        row = ""
+        for column in columns:
+            value = result[column]
+            row += f"{value:>20.1f}" if isinstance(value, float) else f"{str(value):>20}"
+        print(row)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_imgs", type=int, default=128, help="Number of images timed per kernel")
+    parser.add_argument("--height", type=int, default=IMG_HEIGHT)
+    parser.add_argument("--width", type=int, default=IMG_WIDTH)
+    parser.add_argument("--suite", default="all", choices=["kernels", "perturbations", "batch", "all"], help="Which benchmarks to run")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 128, 256], help="Batch sizes generate_augmentations_batch is timed at")
+    parser.add_argument("--curriculum_maxes", type=float, nargs="+", default=[0.1, 0.5, 1.0], help="Curriculum maxima generate_augmentations_batch is timed at")
+    parser.add_argument("--blur_backend", default="exact", choices=BLUR_BACKENDS, help="Blur backend of the perturbations and batch suites")
+    parser.add_argument("--noise_backend", default="exact", choices=NOISE_BACKENDS, help="Noise backend of the perturbations and batch suites")
+    parser.add_argument("--json", default=None, help="File the results are written to as JSON")
+    args = parser.parse_args()
+
+    imgs = get_sample_images(args.num_imgs, args.height, args.width)
+
+    # The backends of the training perturbations, the kernels suite compares the blur backends itself
+    set_blur_backend(args.blur_backend)
+    set_noise_backend(args.noise_backend)
+
+    report = {"run": get_run_info(args)}
+
+    if args.suite in ["kernels", "all"]:
+        print_kernel_benchmarks(imgs, args)
+
+    if args.suite in ["perturbations", "all"]:
+        report["perturbations"] = benchmark_perturbations(imgs)
+        print_results("training perturbations", report["perturbations"], ["name", "level", "us_per_image", "images_per_s", "peak_alloc_bytes"])
+
+        report["test_perturbations"] = benchmark_test_perturbations(imgs)
+        print_results("test perturbations", report["test_perturbations"], ["name", "batched", "us_per_image", "images_per_s", "peak_alloc_bytes"])
+
+    if args.suite in ["batch", "all"]:
+        report["augmentations_batch"] = benchmark_augmentations_batch(imgs, args.batch_sizes, args.curriculum_maxes)
+        print_results("generate_augmentations_batch", report["augmentations_batch"], ["batch_size", "curriculum_max", "ms_per_batch", "images_per_s", "peak_alloc_bytes"])
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote the results to {args.json}")
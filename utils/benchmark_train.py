@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import platform
+
+import numpy as np
+import torch
+
+from pipeline import get_joint_models, get_joint_losses
+from utils.generate_augs import IMG_HEIGHT, IMG_WIDTH
+from utils.benchmark_augs import print_results
+
+'''
+    Throughput of the training step on synthetic inputs, run with --run_mode benchmark so no dataset is needed.
+    The model of --model is timed at every batch size of --benchmark_batch_sizes and thread count of
+    --benchmark_threads, in three modes:
+
+        forward           regressor(encoder(x)) without gradients, as in testing
+        forward_backward  encoder and regressor with the regression loss and its backward pass
+        joint             the whole AutoJoin step of PipelineJoint.train: encoder, decoder and regressor, both
+                          losses, backward and the Adam step
+
+    A mode is run for --benchmark_warmup steps first, then every one of the --benchmark_steps steps is timed
+    on its own and the images/s come from the median step. The results are written as JSON to
+    --benchmark_json (benchmark_<model>.json in logs_dir by default).
+'''
+
+BENCHMARK_MODES = ["forward", "forward_backward", "joint"]
+
+def get_input_shape(args):
+    # The driving frames are 66x200, --img_dim resizes them to squares (and the ViT needs it)
+    if args.img_dim is not None:
+        return (3, args.img_dim, args.img_dim)
+
+    return (3, IMG_HEIGHT, IMG_WIDTH)
+
+def get_synthetic_batch(args, batch_size, device):
+    # Noisy and clean inputs as contiguous NCHW float batches, which is what to_float_batch gives the training loop, and labels
+    shape = get_input_shape(args)
+    noise_batch = torch.rand((batch_size,) + shape, device=device)
+    clean_batch = torch.rand((batch_size,) + shape, device=device)
+
+    if args.num_classes == 1:
+        labels = torch.rand(batch_size, 1, device=device) * 2 - 1
+    else:
+        labels = torch.randint(0, args.num_classes, (batch_size,), device=device)
+
+    return noise_batch, clean_batch, labels
+
+def get_step(mode, models, losses, optimizer, batch, lambda1, lambda2):
+    encoder, decoder, regressor = models
+    recon_loss_fn, regr_loss_fn = losses
+    noise_batch, clean_batch, labels = batch
+
+    def forward():
+        with torch.no_grad():
+            return regressor(encoder(noise_batch))
+
+    def forward_backward():
+        optimizer.zero_grad()
+        regr_loss = regr_loss_fn(regressor(encoder(noise_batch)), labels)
+        regr_loss.backward()
+
+    def joint():
+        # Same as the step in PipelineJoint.train
+        z = encoder(noise_batch)
+        recon_batch = decoder(z)
+        sa_batch = regressor(z)
+
+        loss = (lambda1 * recon_loss_fn(recon_batch, clean_batch)) + (lambda2 * regr_loss_fn(sa_batch, labels))
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    return {"forward": forward, "forward_backward": forward_backward, "joint": joint}[mode]
+
+def time_steps(step, device, warmup, steps):
+    # Seconds per step, synchronizing with CUDA so the asynchronous kernels are counted in their own step
+    sync = torch.cuda.synchronize if device.type == "cuda" else lambda: None
+
+    for i in range(warmup):
+        step()
+    sync()
+
+    times = []
+    for i in range(steps):
+        start_time = time.perf_counter()
+        step()
+        sync()
+        times.append(time.perf_counter() - start_time)
+
+    return np.array(times)
+
+def benchmark_train_step(args, device):
+    torch.manual_seed(args.seed)
+
+    models = get_joint_models(args, device)
+    losses = get_joint_losses(args)
+    params = [p for model in models for p in model.parameters()]
+    optimizer = torch.optim.Adam(params, lr=float(args.lr))
+
+    default_threads = torch.get_num_threads()
+    thread_counts = args.benchmark_threads or [default_threads]
+
+    results = []
+
+    try:
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+
+            for batch_size in args.benchmark_batch_sizes:
+                batch = get_synthetic_batch(args, batch_size, device)
+
+                for mode in args.benchmark_modes:
+                    for model in models:
+                        # Testing runs the models in eval mode, training in train mode
+                        model.train(mode != "forward")
+
+                    if device.type == "cuda":
+                        torch.cuda.reset_peak_memory_stats(device)
+
+                    step = get_step(mode, models, losses, optimizer, batch, args.lambda1, args.lambda2)
+                    times = time_steps(step, device, args.benchmark_warmup, args.benchmark_steps)
+
+                    median = float(np.median(times))
+                    result = {"mode": mode, "threads": num_threads, "batch_size": batch_size,
+                              "images_per_s": batch_size/median, "ms_median": median*1e3,
+                              "ms_mean": float(times.mean())*1e3, "ms_p90": float(np.percentile(times, 90))*1e3}
+
+                    if device.type == "cuda":
+                        result["peak_mem_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+
+                    results.append(result)
+                    print(f"{mode}, {num_threads} threads, batch size {batch_size}: {result['images_per_s']:.1f} images/s")
+    finally:
+        torch.set_num_threads(default_threads)
+
+    return results
+
+def get_run_info(args, device):
+    # What a result depends on, written alongside it in the JSON output
+    info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "torch": torch.__version__,
+            "device": str(device), "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "interop_threads": torch.get_num_interop_threads(), "model": args.model,
+            "num_classes": args.num_classes, "input_shape": list(get_input_shape(args)),
+            "warmup": args.benchmark_warmup, "steps": args.benchmark_steps}
+
+    if device.type == "cuda":
+        info["gpu"] = torch.cuda.get_device_name(device)
+
+    return info
+
+def run_benchmark(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"Using device: {device}")
+
+    report = {"run": get_run_info(args, device), "results": benchmark_train_step(args, device)}
+
+    print_results(f"{args.model} training step throughput", report["results"],
+                  ["mode", "threads", "batch_size", "images_per_s", "ms_median", "ms_p90"])
+
+    json_path = args.benchmark_json
+    if json_path is None:
+        os.makedirs(args.logs_dir, exist_ok=True)
+        json_path = os.path.join(args.logs_dir, f"benchmark_{args.model}.json")
+
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote the results to {json_path}")
+
+    return report
@@ -1,14 +1,18 @@
 from cv2 import blur
 import numpy as np
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, default_collate
 import os
+import queue
+import threading
+import multiprocessing as mp
 from PIL import Image
 import cv2
 import random
 import torchvision.transforms as transforms
 
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
-from utils.generate_augs import generate_RGB_image, generate_HSV_image, generate_distort_image, generate_blur_image, generate_noise_image, generate_random_image
+from utils.generate_augs import generate_RGB_image, generate_HSV_image, generate_distort_image, generate_blur_image, generate_noise_image, generate_random_image, generate_augmentations_batch, distort_image, blur_image, add_noise, get_perturbation, render_perturbation_batch, BATCH_PERTURBATIONS, get_counter_rng, get_method_order, get_scratch
 
 class TrainDriveDataset(Dataset):
     def __init__(self, args, x, y):
@@ -17,18 +21,12 @@ class TrainDriveDataset(Dataset):
         self.x = x # names of images
         self.y = y # steering angles of images
 
-        if self.args.img_dim:
-            img_dim = int(args.img_dim)
-            self.transform = transforms.Compose(
-                [transforms.Resize((img_dim,img_dim)) ,
-                transforms.ToTensor()]
-            )
-        else:
-            self.transform = transforms.Compose(
-                [transforms.ToTensor()]
-            )
+        # Kept in shared memory so the dataloader workers see the curriculum being increased
+        self.curriculum_max = mp.RawValue('d', 0.)
 
-        self.curriculum_max = 0.
+        # Shared the same way, the epoch keys the counter-based generators (see AugmentCollate)
+        self.epoch = mp.RawValue('i', 0)
+        self.return_index = False
 
     def __len__(self):
         return len(self.y)
@@ -42,41 +40,68 @@ class TrainDriveDataset(Dataset):
 
         img = Image.open(img_path)
         img = img.convert("RGB")
-        # img = np.asarray(img)
-        img = self.transform(img)
+
+        if self.args.img_dim:
+            img = img.resize((int(self.args.img_dim), int(self.args.img_dim)), Image.BILINEAR) # what transforms.Resize does
+
+        # Kept uint8 HWC, the training loop converts the batch to float once it is moved (see to_float_batch in pipeline.py)
+        img = np.array(img)
 
         # Correct datatype here
+        if self.return_index:
+            return [img, label.astype(np.float32), key]
+
         return [img, label.astype(np.float32)]
     
     def increase_curr_max(self):
-        self.curriculum_max += 0.1
+        self.curriculum_max.value += 0.1
     
     def get_curr_max(self):
-        return self.curriculum_max
+        return self.curriculum_max.value
     
     def set_curr_max(self, cv):
-        self.curriculum_max = cv
+        self.curriculum_max.value = cv
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def get_epoch(self):
+        return self.epoch.value
 
 class ClassifyDataset(Dataset):
     def __init__(self, dataset):
         self.dataset = dataset
 
-        self.curriculum_max = 0.
+        # Kept in shared memory so the dataloader workers see the curriculum being increased
+        self.curriculum_max = mp.RawValue('d', 0.)
+
+        # Shared the same way, the epoch keys the counter-based generators (see AugmentCollate)
+        self.epoch = mp.RawValue('i', 0)
+        self.return_index = False
     
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, key):
+        if self.return_index:
+            return [*self.dataset[key], key]
+
         return self.dataset[key]
 
     def increase_curr_max(self):
-        self.curriculum_max += 0.1
+        self.curriculum_max.value += 0.1
     
     def get_curr_max(self):
-        return self.curriculum_max
+        return self.curriculum_max.value
     
     def set_curr_max(self, cv):
-        self.curriculum_max = cv
+        self.curriculum_max.value = cv
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def get_epoch(self):
+        return self.epoch.value
 
 class TrainDriveDatasetNP(Dataset):
     def __init__(self, args, x, y):
@@ -121,7 +146,184 @@ class TrainDriveDatasetNP(Dataset):
     def set_curr_max(self, cv):
         self.curriculum_max = cv
 
-# Just going to assume that this class uses npz files. If using images, then see first class for example
+# Reads from the pre-decoded frame store built by utils/frame_store.py. Unlike the classes above,
+# images are returned as uint8 HWC views into the memmap (no decode, no copy).
+class TrainDriveDatasetMM(Dataset):
+    def __init__(self, args, frames, y, indices):
+        self.args = args
+
+        self.frames = frames # memmap of all of the frames in the store
+        self.y = y # steering angles of all of the frames in the store
+        self.indices = indices # indices into the store that make up this split
+
+        # Kept in shared memory so the dataloader workers see the curriculum being increased
+        self.curriculum_max = mp.RawValue('d', 0.)
+
+        # Shared the same way, the epoch keys the counter-based generators (see AugmentCollate)
+        self.epoch = mp.RawValue('i', 0)
+        self.return_index = False
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        index = self.indices[key]
+
+        if self.return_index:
+            return [self.frames[index], self.y[index], key]
+
+        return [self.frames[index], self.y[index]]
+
+    def increase_curr_max(self):
+        self.curriculum_max.value += 0.1
+
+    def get_curr_max(self):
+        return self.curriculum_max.value
+
+    def set_curr_max(self, cv):
+        self.curriculum_max.value = cv
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def get_epoch(self):
+        return self.epoch.value
+
+# collate_fn that runs generate_augmentations_batch inside the dataloader workers instead of the training
+# loop. Batches come out as [clean_batch, noise_batch, labels] like TrainDriveDatasetPerturb, but still uint8:
+# the clean batch (B, H, W, C) and the noise batch (B, C, H, W).
+# With a seed, the dataset has to return the sample indices and the perturbations are drawn from the
+# counter-based generators of the samples, which makes them independent of the workers and batches.
+class AugmentCollate:
+    def __init__(self, dataset, seed=None):
+        self.dataset = dataset # read for the curriculum max and the epoch, which are shared with the parent process
+        self.seed = seed
+
+    def __call__(self, batch):
+        if self.seed is None:
+            clean_batch, labels = default_collate(batch)
+            sample_keys = None
+        else:
+            clean_batch, labels, indices = default_collate(batch)
+            sample_keys = (self.seed, self.dataset.get_epoch(), indices.numpy())
+
+        # The output buffer is reused between batches, so the noise batch is copied out of it
+        images = clean_batch.numpy()
+        out = get_scratch("augment_out", (images.shape[0], images.shape[3], images.shape[1], images.shape[2]))
+        noise_batch = generate_augmentations_batch(images, self.dataset.get_curr_max(), sample_keys, out)
+
+        noise_batch = torch.from_numpy(noise_batch.copy())
+
+        return [clean_batch, noise_batch, labels]
+
+# Iterates over a dataloader with the next batches already staged on the device. A background thread
+# takes the batches from the loader, runs prepare on them (e.g. the perturbations) and copies their tensors
+# to the device, up to depth batches ahead of the training step. On CUDA the copies are made from pinned
+# memory on a stream of their own, the step waits for them with an event. On other devices the tensors
+# are moved with a plain .to(), which is a no-op on the CPU where the overlap comes from the thread alone.
+class DevicePrefetcher:
+    def __init__(self, loader, device, prepare=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+        # prepare(data, slot) returns the items of a batch. slot cycles through num_slots values, a
+        # batch written to buffers reused by slot is not overwritten before the step is done with it
+        self.prepare = prepare
+        self.num_slots = depth + 2
+
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+        # The current pass, read by the resource telemetry for the queue depths
+        self.loader_iter = None
+        self.batches = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def queue_depth(self):
+        # Batches staged and waiting for the step
+        return self.batches.qsize() if self.batches is not None else 0
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        self.batches = batches
+
+        thread = threading.Thread(target=self.produce, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                kind, item, event = batches.get()
+
+                if kind == "error":
+                    raise item
+                if kind == "done":
+                    break
+
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for value in item:
+                        if isinstance(value, torch.Tensor):
+                            value.record_stream(current_stream) # allocated on the copy stream, used on this one
+
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def produce(self, batches, stop):
+        def put(entry):
+            # Giving up when the consumer is gone, e.g. it stopped early or raised
+            while not stop.is_set():
+                try:
+                    batches.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            self.loader_iter = iter(self.loader)
+
+            for i, data in enumerate(self.loader_iter):
+                if stop.is_set():
+                    return
+
+                item = self.prepare(data, i % self.num_slots) if self.prepare is not None else data
+                item, event = self.to_device(item)
+
+                if not put(("batch", item, event)):
+                    return
+
+            put(("done", None, None))
+        except Exception as e:
+            put(("error", e, None))
+
+    def to_device(self, item):
+        if self.stream is None:
+            return [value.to(self.device) if isinstance(value, torch.Tensor) else value for value in item], None
+
+        with torch.cuda.stream(self.stream):
+            moved = []
+            for value in item:
+                if isinstance(value, torch.Tensor):
+                    if not value.is_pinned():
+                        value = value.pin_memory()
+                    value = value.to(self.device, non_blocking=True)
+                moved.append(value)
+
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        return moved, event
+
+# Just going to assume that this class uses npz files. If using images, then see first class for example.
+# Like the other training datasets, items stay uint8: [clean (H, W, C), perturbed (C, H, W), label], and the
+# training loop converts them to float once they are moved (see to_float_batch in pipeline.py). The
+# perturbations work on the numpy source array with cv2, there are no PIL or torchvision transforms per call.
 class TrainDriveDatasetPerturb(Dataset):
     def __init__(self, args, x, y):
         self.args = args
@@ -129,21 +331,18 @@ class TrainDriveDatasetPerturb(Dataset):
         self.x = x # numpy array of images
         self.y = y # steering angles of images
 
-        if self.args.img_dim:
-            img_dim = int(args.img_dim)
-            self.transform = transforms.Compose(
-                [transforms.Resize((img_dim,img_dim)) ,
-                transforms.ToTensor()]
-            )
-        else:
-            self.transform = transforms.Compose(
-                [transforms.ToTensor()]
-            )
+        self.img_dim = int(args.img_dim) if self.args.img_dim else None
 
-        self.curriculum_max = 0
+        # Kept in shared memory so the dataloader workers see the curriculum being increased
+        self.curriculum_max = mp.RawValue('d', 0.)
         self.i = 0
         self.methods = [self.perturb_brightness, self.perturb_contrast, self.perturb_saturation,
                         self.perturb_hue, self.perturb_noise, self.perturb_blur, self.perturb_distort]
+
+        # With --counter_rng, the method and the random draws of a sample come from its counter-based generator
+        # instead of self.i and the global RNGs, so they don't depend on the worker that loads it
+        self.seed = args.seed if args.counter_rng == "true" else None
+        self.epoch = mp.RawValue('i', 0)
         
 
     def __len__(self):
@@ -153,131 +352,113 @@ class TrainDriveDatasetPerturb(Dataset):
         img = self.x[key]
         label = self.y[key]
 
-        clean_img = img.copy()
-        clean_img = self.transform(clean_img)
+        clean_img = self.resize(img)
 
-        if self.i % len(self.methods) == 0:
-            random.shuffle(self.methods)
-    
-        perturbation = self.methods[self.i%len(self.methods)]
-        noise_img = perturbation(img)
+        if self.seed is None:
+            if self.i % len(self.methods) == 0:
+                random.shuffle(self.methods)
+        
+            perturbation = self.methods[self.i%len(self.methods)]
+            noise_img = perturbation(img)
+
+            self.increase_i()
+        else:
+            epoch = self.epoch.value
+            order = get_method_order(self.seed, epoch, len(self.methods))
+
+            perturbation = self.methods[order[key % len(self.methods)]]
+            noise_img = perturbation(img, get_counter_rng(self.seed, epoch, key))
 
-        self.increase_i()
+        noise_img = np.moveaxis(self.resize(noise_img), -1, 0)
 
         return [clean_img, noise_img, label.astype(np.float32)]
     
     def increase_curr_max(self):
-        self.curriculum_max += 0.1
+        self.curriculum_max.value += 0.1
     
     def get_curr_max(self):
-        return self.curriculum_max
+        return self.curriculum_max.value
     
     def set_curr_max(self, cv):
-        self.curriculum_max = cv
+        self.curriculum_max.value = cv
     
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def get_epoch(self):
+        return self.epoch.value
+
     def increase_i(self):
         self.i += 1
 
-    def perturb_noise(self, img):
-        intensity = np.random.uniform(high=self.curriculum_max)
-        noise_level = int(intensity * (200 - 20) + 20)
+    def resize(self, img):
+        # In place of transforms.Resize, INTER_AREA being cv2's antialiased downscaling
+        if self.img_dim is None:
+            return img
 
-        def add_noise(image, sigma):
-            row,col,ch= image.shape
-            mean = 0
-            gauss = np.random.normal(mean,sigma,(row,col,ch))
-            gauss = gauss.reshape(row,col,ch)
-            noisy = image + gauss
-            noisy = np.float32(noisy)
-            return noisy
+        return cv2.resize(img, (self.img_dim, self.img_dim), interpolation=cv2.INTER_AREA)
 
-        img = np.uint8(add_noise(img, noise_level))
-        img = Image.fromarray(img).convert("RGB")
-        img = self.transform(img)
+    def uniform(self, low, high, rng):
+        return (np.random if rng is None else rng).uniform(low, high)
 
-        return img
+    def blend_lut(self, degenerate, factor):
+        # Table of PIL's Image.blend(degenerate, img, factor) for a constant degenerate image, which is what
+        # ImageEnhance (and so ColorJitter) does for brightness and contrast
+        values = degenerate + factor * (np.arange(256) - degenerate)
 
-    def perturb_blur(self, img):
-        intensity = np.random.uniform(high=self.curriculum_max)
+        return np.clip(values, 0, 255).astype(np.uint8)
+
+    def perturb_noise(self, img, rng=None):
+        intensity = self.uniform(0., self.curriculum_max.value, rng)
+        noise_level = int(intensity * (200 - 20) + 20)
+
+        return np.uint8(add_noise(img, noise_level, rng))
+
+    def perturb_blur(self, img, rng=None):
+        intensity = self.uniform(0., self.curriculum_max.value, rng)
         blur_level = int(intensity * (107 - 7) + 7)
         if blur_level % 2 == 0: # blur has to be an odd number
             blur_level += 1
         
-        img = np.uint8(cv2.GaussianBlur(img, (blur_level, blur_level), 0))
-        img = Image.fromarray(img).convert("RGB")
-        img = self.transform(img)
-
-        return img
+        return np.uint8(blur_image(img, blur_level))
 
-    def perturb_distort(self, img):
-        intensity = np.random.uniform(high=self.curriculum_max)
+    def perturb_distort(self, img, rng=None):
+        intensity = self.uniform(0., self.curriculum_max.value, rng)
         distort_level = int(intensity * (500 - 1) + 1)
 
-        K = np.eye(3)*1000
-        K[0,2] = img.shape[1]/2
-        K[1,2] = img.shape[0]/2
-        K[2,2] = 1
-
-        img = np.uint8(cv2.undistort(img, K, np.array([distort_level,distort_level,0,0])))
-        img = Image.fromarray(img).convert("RGB")
-        img = self.transform(img)
-
-        return img
-
-    def perturb_brightness(self, img):
-        img = Image.fromarray(img).convert("RGB")
-
-        brightness = transforms.ColorJitter(brightness=(0,1),
-                                    contrast=(0,0),
-                                    saturation=(0,0),
-                                    hue=(0,0))
-
-        img = brightness(img)
-        img = self.transform(img)
-
-        return img
-
-    def perturb_contrast(self, img):
-        img = Image.fromarray(img).convert("RGB")
-
-        contrast = transforms.ColorJitter(brightness=(0,0),
-                                    contrast=(0,1),
-                                    saturation=(0,0),
-                                    hue=(0,0))
-
-        img = contrast(img)
-        img = self.transform(img)
+        return np.uint8(distort_image(img, distort_level))
 
-        return img
+    def perturb_brightness(self, img, rng=None):
+        # Blending with black
+        factor = self.uniform(0., 1., rng)
 
-    def perturb_saturation(self, img):
-        img = Image.fromarray(img).convert("RGB")
+        return cv2.LUT(img, self.blend_lut(0, factor))
 
-        saturation = transforms.ColorJitter(brightness=(0,0),
-                                    contrast=(0,0),
-                                    saturation=(0,1),
-                                    hue=(0,0))
+    def perturb_contrast(self, img, rng=None):
+        # Blending with the mean gray level
+        factor = self.uniform(0., 1., rng)
+        mean = int(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY).mean() + 0.5)
 
-        img = saturation(img)
-        img = self.transform(img)
+        return cv2.LUT(img, self.blend_lut(mean, factor))
 
-        return img
+    def perturb_saturation(self, img, rng=None):
+        # Blending with the grayscale image
+        factor = self.uniform(0., 1., rng)
+        gray = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
 
-    def perturb_hue(self, img):
-        img = Image.fromarray(img).convert("RGB")
+        return cv2.addWeighted(img, factor, gray, 1. - factor, 0.)
 
-        hue = transforms.ColorJitter(brightness=(0,0),
-                            contrast=(0,0),
-                            saturation=(0,0),
-                            hue=(-0.5, 0.5))
+    def perturb_hue(self, img, rng=None):
+        # Rotating the hue, which is 0-255 in the _FULL conversions like it is in PIL's HSV
+        factor = self.uniform(-0.5, 0.5, rng)
 
-        img = hue(img)
-        img = self.transform(img)
+        hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL)
+        hsv[..., 0] += np.uint8(int(factor * 255) % 256)
 
-        return img
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB_FULL)
 
 class TestDriveDataset(Dataset):
-    def __init__(self, args, x, y, test_perturb, test_num):
+    def __init__(self, args, x, y, test_perturb, test_num, cached_frames=None):
         self.args = args
         self.x = x # name of clean image
         self.y = y # steering angle label
@@ -285,144 +466,36 @@ class TestDriveDataset(Dataset):
         self.test_perturb = test_perturb
         self.test_num = test_num
 
+        # Pre-rendered frames of a single perturbation from the test cache (see utils/frame_store.py)
+        self.cached_frames = cached_frames
+
+        # Combined and unseen sets rendered from the clean frames, in batches, by RenderCollate
+        self.render = self.test_num >= 76 and args.render_unseen == "true" and self.test_perturb in BATCH_PERTURBATIONS
+
+        # Resolving the perturbation once, only the clean and the pre-rendered sets are read as is
+        if self.test_perturb == "random" or 0 < self.test_num < 76:
+            self.kernel = get_perturbation(self.test_perturb)
+        else:
+            self.kernel = None
+
         self.transform = transforms.Compose(
                 [transforms.ToTensor()]
             )
 
         assert (len(self.x) == len(self.y))
-    
-    def perturb(self, x):
-        def get_aug_method(test_perturb):
-            if test_perturb == "random":
-                return "random", 0
-
-            word_array = test_perturb.split('_')
-            aug_method = ""
-
-            for x in range(len(word_array)):
-                if x != len(word_array) - 1:
-                    aug_method += word_array[x] + " "
-                else:
-                    aug_method += word_array[x]
-            
-            aug_method_test = aug_method[:-2]
-            aug_level_test = aug_method[-1]
-
-            return aug_method_test, aug_level_test
-        
-        test_perturb_name, test_level = get_aug_method(self.test_perturb)
-        
-        rgb_dark_light = {
-            0: [2, 4],
-            1: [2, 5],
-            2: [1, 4],
-            3: [1, 5],
-            4: [0, 4],
-            5: [0, 5]
-        }
-
-        dark_light = {
-            0: [0, 4],
-            1: [0, 5],
-            2: [1, 4],
-            3: [1, 5],
-            4: [2, 4],
-            5: [2, 5]
-        }
-
-        rgb_hsv_levels = {
-            "1": 0.02,
-            "2": 0.2,
-            "3": 0.5,
-            "4": 0.65,
-            "5": 1.0
-        }
-
-        if test_perturb_name == "R lighter":
-            values = rgb_dark_light[5]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-    
-        if test_perturb_name == "R darker":
-            values = rgb_dark_light[4]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
 
-        if test_perturb_name == "G lighter":
-            values = rgb_dark_light[3]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "G darker":
-            values = rgb_dark_light[2]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "B lighter":
-            values = rgb_dark_light[1]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "B darker":
-            values = rgb_dark_light[0]
-            noise_image = generate_RGB_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "H darker":
-            values = dark_light[0]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-        
-        if test_perturb_name == "H lighter":
-            values = dark_light[1]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-        
-        if test_perturb_name == "S darker":
-            values = dark_light[2]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-        
-        if test_perturb_name == "S lighter":
-            values = dark_light[3]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "V darker":
-            values = dark_light[4]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        if test_perturb_name == "V lighter":
-            values = dark_light[5]
-            noise_image = generate_HSV_image(x, values[0], values[1], dist_ratio=rgb_hsv_levels[test_level])
-
-        blur_levels = {
-            "1": 7,
-            "2": 17,
-            "3": 37,
-            "4": 67,
-            "5": 107
-        }
-
-        noise_levels = {
-            "1": 20,
-            "2": 50,
-            "3": 100,
-            "4": 150,
-            "5": 200 
-        }
-
-        distort_levels = {
-            "1": 1,
-            "2": 10,
-            "3": 50,
-            "4": 200,
-            "5": 500
-        }
-
-        if test_perturb_name == "blur":
-            noise_image = generate_blur_image(x, blur_levels[test_level])
-
-        if test_perturb_name == "noise":
-            noise_image = generate_noise_image(x, noise_levels[test_level])
-        
-        if test_perturb_name == "distort":
-            noise_image = generate_distort_image(x, distort_levels[test_level])
+    def is_deterministic(self):
+        # Noise (and random, which can pick noise) draw from np.random, everything else is a pure function of the image
+        if self.test_perturb == "random":
+            return False
 
-        if test_perturb_name == "random":
-            noise_image = generate_random_image(x, 1) # the 2nd value being passed is different from above methods as its curr max
+        if self.cached_frames is not None:
+            return True
 
-        return noise_image
+        return not (0 < self.test_num < 76 and self.test_perturb.startswith("noise"))
+    
+    def perturb(self, x):
+        return self.kernel(x)
 
     def __len__(self):
         return len(self.x)
@@ -430,6 +503,11 @@ class TestDriveDataset(Dataset):
     def __getitem__(self, key):
         label = self.y[key]
 
+        if self.render: # the clean frame and its index, RenderCollate perturbs and converts the batch
+            img_path = f'{self.args.data_dir}/{self.args.dataset}/test/clean/{self.x[key]}' + ".jpg"
+
+            return [np.asarray(Image.open(img_path)), key, label.astype(np.float32)]
+
         if self.test_perturb != "random":
             if self.test_num < 1: # Clean 
                 img_path = f'{self.args.data_dir}/{self.args.dataset}/test/clean/{self.x[key]}' + ".jpg"
@@ -441,6 +519,9 @@ class TestDriveDataset(Dataset):
                 # img = img.convert("RGB")
                 # img = np.moveaxis(np.asarray(img), -1, 0)
 
+            elif self.test_num < 76 and self.cached_frames is not None: # Single Perturbation, already rendered
+                img = Image.fromarray(np.asarray(self.cached_frames[key]), "RGB")
+
             elif self.test_num < 76: # Single Perturbation
                 img_path = f'{self.args.data_dir}/{self.args.dataset}/test/clean/{self.x[key]}' + ".jpg"
             
@@ -476,4 +557,66 @@ class TestDriveDataset(Dataset):
         
         img = self.transform(img)
 
-        return [img, label.astype(np.float32)]
\ No newline at end of file
+        return [img, label.astype(np.float32)]
+
+class RenderCollate:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __call__(self, batch):
+        images = np.stack([item[0] for item in batch])
+        labels = default_collate([item[2] for item in batch])
+
+        # Seeded per image from (seed, test index, image index), so an image renders the same in any batch or worker
+        seeds = [(self.dataset.args.seed, self.dataset.test_num, int(item[1])) for item in batch]
+        images = render_perturbation_batch(images, self.dataset.test_perturb, seeds)
+
+        if self.dataset.args.img_dim:
+            img_dim = self.dataset.args.img_dim
+            images = np.stack([np.moveaxis(np.asarray(Image.fromarray(np.moveaxis(img, 0, -1), "RGB").resize((img_dim, img_dim))), -1, 0) for img in images])
+
+        # Same conversion as ToTensor
+        return [torch.from_numpy(images).float().div(255.), labels]
+
+# Image-major version of TestDriveDataset for the single perturbations. Each clean image is decoded
+# once and every perturbation in test_perturbs is applied to it, so an item is a (P, C, H, W) uint8
+# tensor holding all P perturbed variants of one image.
+class TestDriveDatasetFanout(Dataset):
+    def __init__(self, args, x, y, test_perturbs):
+        self.args = args
+        self.x = x # name of clean image
+        self.y = y # steering angle label
+
+        self.test_perturbs = test_perturbs
+
+        # Resolving the kernel of every perturbation name (e.g. R_darker_1) once up front
+        self.kernels = [get_perturbation(test_perturb) for test_perturb in self.test_perturbs]
+
+        assert (len(self.x) == len(self.y))
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, key):
+        label = self.y[key]
+
+        img_path = f'{self.args.data_dir}/{self.args.dataset}/test/clean/{self.x[key]}' + ".jpg"
+
+        if not os.path.isfile(img_path):
+            print(img_path, " not exists")
+
+        img = np.asarray(Image.open(img_path))
+
+        imgs = []
+        for kernel in self.kernels:
+            noise_img = np.uint8(kernel(img.copy()))
+
+            if self.args.img_dim:
+                noise_img = Image.fromarray(np.moveaxis(noise_img, 0, -1), "RGB")
+                noise_img = noise_img.resize((self.args.img_dim, self.args.img_dim))
+                noise_img = np.moveaxis(np.asarray(noise_img), -1, 0)
+
+            imgs.append(noise_img)
+
+        # Kept as uint8 to keep the fanned out batches small, converted to float the same way ToTensor does it
+        return [torch.from_numpy(np.stack(imgs)), label.astype(np.float32)]
@@ -0,0 +1,212 @@
+import os
+import csv
+import random
+import shutil
+import hashlib
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+'''
+    Pre-decoded frame store. The frames of a split are decoded once and packed into a single
+    uint8 .npy file (N x H x W x 3) that is memory-mapped at training time, so the dataloader
+    workers never have to open or JPEG-decode an image again.
+
+    The same is done for the single perturbation test sets: build_test_cache renders every
+    (perturbation, level) variant of the clean test set once, so evaluations read them back
+    instead of perturbing the clean frames again.
+'''
+
+IMG_HEIGHT = 66
+IMG_WIDTH = 200
+
+def get_frame_store_paths(data_dir, dataset, split="train"):
+    store_dir = os.path.join(data_dir, f"{dataset}")
+
+    frames_path = os.path.join(store_dir, f"frames_{split}.npy")
+    labels_path = os.path.join(store_dir, f"frames_labels_{split}.npy")
+
+    return frames_path, labels_path
+
+def frame_store_exists(data_dir, dataset, split="train"):
+    frames_path, labels_path = get_frame_store_paths(data_dir, dataset, split)
+
+    return os.path.isfile(frames_path) and os.path.isfile(labels_path)
+
+def build_frame_store(data_dir, dataset, split="train", img_dim=None):
+    '''
+        Packs labels_<split>.csv and all of the frames it lists into a fixed-shape uint8 memmap.
+        The frames are stored in csv order as RGB, HWC. If img_dim is given, the frames are
+        resized to img_dim x img_dim, otherwise they are stored at 66 x 200.
+    '''
+
+    label_path = os.path.join(data_dir, f"{dataset}", f"labels_{split}.csv")
+    image_dir = os.path.join(data_dir, f"{dataset}", split if split == "train" else os.path.join(split, "clean"))
+
+    names = []
+    labels = []
+
+    with open(label_path, 'r') as csvfile:
+        csvreader = csv.reader(csvfile)
+
+        for row in csvreader:
+            names.append(str(row[0][:-4]))
+            labels.append(float(row[-1]))
+
+    if img_dim:
+        height, width = int(img_dim), int(img_dim)
+    else:
+        height, width = IMG_HEIGHT, IMG_WIDTH
+
+    frames_path, labels_path = get_frame_store_paths(data_dir, dataset, split)
+
+    # Writing to a temporary file first so a half-built store is never picked up by training
+    tmp_path = frames_path + ".tmp"
+    frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(names), height, width, 3))
+
+    for i in tqdm(range(len(names))):
+        img_path = os.path.join(image_dir, names[i] + ".jpg")
+
+        if not os.path.isfile(img_path):
+            raise FileNotFoundError(f"{img_path} not exists")
+
+        # Decoding the same way TrainDriveDataset does so both paths see identical pixels
+        img = Image.open(img_path).convert("RGB")
+
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.BILINEAR)
+
+        frames[i] = np.asarray(img)
+
+    frames.flush()
+    del frames
+
+    os.replace(tmp_path, frames_path)
+    np.save(labels_path, np.asarray(labels, dtype=np.float32))
+
+    print(f"Wrote {len(names)} frames of shape {height}x{width}x3 to {frames_path}")
+
+    return frames_path, labels_path
+
+def load_frame_store(data_dir, dataset, split="train"):
+    '''
+        Returns the memmap of frames and the label array of a built frame store. The memmap is
+        opened copy-on-write so the views handed to torch are writable without touching the file.
+    '''
+
+    frames_path, labels_path = get_frame_store_paths(data_dir, dataset, split)
+
+    frames = np.load(frames_path, mmap_mode='c')
+    labels = np.load(labels_path)
+
+    assert (len(frames) == len(labels))
+
+    return frames, labels
+
+def get_perturb_code_version():
+    # Hash of the perturbation code, so a test cache rendered with older kernels is never read back
+    augs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_augs.py")
+
+    with open(augs_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+def get_test_cache_paths(data_dir, dataset, seed, version=None):
+    if version is None:
+        version = get_perturb_code_version()
+
+    cache_dir = os.path.join(data_dir, f"{dataset}", "test_cache", f"seed{seed}_{version}")
+
+    frames_path = os.path.join(cache_dir, "frames.npy")
+    names_path = os.path.join(cache_dir, "perturbs.txt")
+
+    return frames_path, names_path
+
+def build_test_cache(data_dir, dataset, seed, test_perturbs):
+    '''
+        Renders each perturbation in test_perturbs (names from aug_list_all.txt) over the clean test
+        set into a (P, N, H, W, 3) uint8 store, keyed by the seed and the version of the perturbation
+        code. Caches of the same seed built with other versions of the code are removed.
+    '''
+
+    # Imported here so the frame store doesn't pull in the perturbation code it doesn't need
+    from utils.generate_augs import get_perturbation
+
+    label_path = os.path.join(data_dir, f"{dataset}", "labels_test.csv")
+    image_dir = os.path.join(data_dir, f"{dataset}", "test", "clean")
+
+    names = []
+
+    with open(label_path, 'r') as csvfile:
+        csvreader = csv.reader(csvfile)
+
+        for row in csvreader:
+            names.append(str(row[0][:-4]))
+
+    # Decoding the same way TestDriveDataset does
+    clean_frames = []
+    for name in tqdm(names):
+        img_path = os.path.join(image_dir, name + ".jpg")
+
+        if not os.path.isfile(img_path):
+            raise FileNotFoundError(f"{img_path} not exists")
+
+        clean_frames.append(np.asarray(Image.open(img_path)))
+
+    clean_frames = np.stack(clean_frames)
+
+    frames_path, names_path = get_test_cache_paths(data_dir, dataset, seed)
+    cache_dir = os.path.dirname(frames_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tmp_path = frames_path + ".tmp"
+    frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(test_perturbs),) + clean_frames.shape)
+
+    for p, test_perturb in enumerate(test_perturbs):
+        print(f"Rendering {test_perturb}")
+        kernel = get_perturbation(test_perturb)
+
+        # Seeded per perturbation and rendered in test set order, which gives the same random draws
+        # (only the noise uses any) as evaluating the perturbation on the fly
+        random.seed(seed)
+        np.random.seed(seed)
+
+        for i in range(len(clean_frames)):
+            frames[p, i] = np.moveaxis(np.uint8(kernel(clean_frames[i].copy())), 0, -1)
+
+    frames.flush()
+    del frames
+
+    os.replace(tmp_path, frames_path)
+    with open(names_path, 'w') as f:
+        f.write("\n".join(test_perturbs) + "\n")
+
+    # Dropping the stale caches of this seed
+    test_cache_dir = os.path.dirname(cache_dir)
+    for entry in os.listdir(test_cache_dir):
+        if entry.startswith(f"seed{seed}_") and os.path.join(test_cache_dir, entry) != cache_dir:
+            shutil.rmtree(os.path.join(test_cache_dir, entry))
+
+    print(f"Wrote {len(test_perturbs)} perturbations of {len(names)} frames to {frames_path}")
+
+    return frames_path, names_path
+
+def load_test_cache(data_dir, dataset, seed):
+    '''
+        Returns a dict from perturbation name to its (N, H, W, 3) memmap of frames, or None if there
+        is no cache for this seed that was rendered with the current perturbation code.
+    '''
+
+    frames_path, names_path = get_test_cache_paths(data_dir, dataset, seed)
+
+    if not (os.path.isfile(frames_path) and os.path.isfile(names_path)):
+        return None
+
+    frames = np.load(frames_path, mmap_mode='r')
+
+    with open(names_path, 'r') as f:
+        test_perturbs = [line.strip() for line in f if line.strip()]
+
+    assert (len(frames) == len(test_perturbs))
+
+    return {test_perturb: frames[p] for p, test_perturb in enumerate(test_perturbs)}
@@ -7,7 +7,9 @@ from __future__ import print_function
 import cv2 # Import the OpenCV library
 import numpy as np # Import Numpy library
 import matplotlib.pyplot as plt # Import matplotlib functionality
+import math
 import random
+from functools import partial, lru_cache
 
 RGB_MAX = 255
 HSV_H_MAX = 180
@@ -31,10 +33,106 @@ DISTORT_MIN = -2.30258509299
 DISTORT_MAX = 5.3
 COLOR_SCALE = 0.25
 
-def add_noise(image, sigma):
+# Number of (shape, distort level) undistortion maps kept around, the levels are integers in [1, 500]
+DISTORT_CACHE_SIZE = 1024
+
+# Backends for the blur perturbation:
+#   exact     - cv2.GaussianBlur
+#   separable - the cached 1D Gaussian kernel applied with cv2.sepFilter2D
+#   box       - a cascade of three box filters approximating the Gaussian, for kernels of at least
+#               BOX_BLUR_MIN_LEVEL (separable is used below that, where three boxes approximate poorly)
+# BLUR_MAX_ERROR is the max absolute pixel difference to exact measured over every odd kernel size from 7
+# to 107 on 66x200 frames, including impulse, checkerboard and step edge images. utils/benchmark_augs.py checks it.
+BLUR_BACKENDS = ["exact", "separable", "box"]
+BLUR_MAX_ERROR = {"exact": 0, "separable": 2, "box": 5}
+BOX_BLUR_MIN_LEVEL = 21
+
+blur_backend = "exact"
+
+# Backends for the noise perturbation:
+#   exact - a fresh float64 np.random.normal draw per image
+#   bank  - windows of a float32 unit normal buffer filled once (see NoiseBank), scaled by sigma
+NOISE_BACKENDS = ["exact", "bank"]
+NOISE_BANK_SIZE = 1 << 22 # float32 values, 16 MB
+
+noise_backend = "exact"
+noise_bank = None
+
+# Optional cache of the deterministic blur and distort outputs (see utils/perturb_cache.py), off unless set
+perturb_cache = None
+
+# Share of the training images given a combined perturbation (see combine_batch), off unless set
+combined_frac = 0.
+
+# Work buffers reused across calls of the batched kernels, by name (see get_scratch)
+scratch_buffers = {}
+
+# The RGB/HSV perturbations map each of the 256 channel values through a lookup table. Tables are cached
+# per (max value, direction, ratio), and the continuous training ratios are rounded to 1/LUT_RATIO_STEPS so
+# they hit the cache. The test levels (0.02, 0.2, 0.5, 0.65, 1.0) are unchanged by the rounding.
+LUT_CACHE_SIZE = 8192
+LUT_RATIO_STEPS = 1000
+
+class NoiseBank:
+    '''
+        Buffer of float32 unit normal samples that is filled once and then served as windows starting at
+        random offsets, scaled by sigma. The buffer is seeded from np.random when it is created and the
+        offsets are drawn from np.random, so the noise is as reproducible as the np.random.normal draws
+        it replaces. Forked dataloader workers share the parent's buffer and only differ in their offsets.
+    '''
+
+    def __init__(self, size=NOISE_BANK_SIZE, seed=None):
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+
+        self.buffer = np.random.default_rng(seed).standard_normal(size, dtype=np.float32)
+
+    def sample(self, shape, sigma, rng=None):
+        num_values = int(np.prod(shape))
+        if rng is None:
+            offset = np.random.randint(0, len(self.buffer) - num_values + 1)
+        else:
+            offset = rng.integers(0, len(self.buffer) - num_values + 1)
+
+        return self.buffer[offset:offset+num_values].reshape(shape) * np.float32(sigma)
+
+    def draw_offsets(self, num_values, count, rngs=None):
+        # Start of each of the count windows, from np.random or from the generator of each window
+        if rngs is None:
+            return np.random.randint(0, len(self.buffer) - num_values + 1, size=count)
+
+        return np.asarray([rng.integers(0, len(self.buffer) - num_values + 1) for rng in rngs], dtype=np.int64)
+
+    def window(self, offset, shape):
+        return self.buffer[offset:offset+int(np.prod(shape))].reshape(shape)
+
+def set_noise_backend(backend):
+    global noise_backend
+
+    assert backend in NOISE_BACKENDS, f"Unknown noise backend {backend}"
+    noise_backend = backend
+
+def get_noise_bank():
+    global noise_bank
+
+    if noise_bank is None:
+        noise_bank = NoiseBank()
+
+    return noise_bank
+
+def add_noise(image, sigma, rng=None):
+    if noise_backend == "bank":
+        # float32 throughout, no float64 temporaries
+        noisy = get_noise_bank().sample(image.shape, sigma, rng)
+        noisy += image
+        return noisy
+
+    if rng is None:
+        rng = np.random
+
     row,col,ch= image.shape
     mean = 0
-    gauss = np.random.normal(mean,sigma,(row,col,ch))
+    gauss = rng.normal(mean,sigma,(row,col,ch))
     gauss = gauss.reshape(row,col,ch)
     noisy = image + gauss
     noisy = np.float32(noisy)
@@ -51,37 +149,169 @@ def perturb_noise(image, dist_ratio):
     noise_level = int(dist_ratio * (200 - 20) + 20)
     return generate_noise_image(image, noise_level)
 
-def generate_blur_image(image, blur_level=7):
+def set_blur_backend(backend):
+    global blur_backend
+
+    assert backend in BLUR_BACKENDS, f"Unknown blur backend {backend}"
+    blur_backend = backend
+
+@lru_cache(maxsize=None)
+def get_gaussian_kernel(blur_level):
+    # Same kernel cv2.GaussianBlur uses when sigma is 0
+    return cv2.getGaussianKernel(blur_level, 0, cv2.CV_32F)
+
+@lru_cache(maxsize=None)
+def get_box_sizes(blur_level, num_boxes=3):
+    # Widths of the box filters whose cascade has the same variance as the Gaussian (P. Kovesi, Fast Almost-Gaussian Filtering)
+    sigma = 0.3*((blur_level-1)*0.5 - 1) + 0.8
+
+    w_ideal = math.sqrt(12*sigma*sigma/num_boxes + 1)
+    w_low = int(math.floor(w_ideal))
+    if w_low % 2 == 0:
+        w_low -= 1
+    w_high = w_low + 2
+
+    num_low = round((12*sigma*sigma - num_boxes*w_low*w_low - 4*num_boxes*w_low - 3*num_boxes) / (-4*w_low - 4))
+
+    return tuple(w_low if i < num_low else w_high for i in range(num_boxes))
+
+def precompute_blur_levels(levels=BLUR_LVL):
+    # Fills the kernel caches for the given levels, e.g. before forking the dataloader workers
+    for blur_level in levels:
+        get_gaussian_kernel(blur_level)
+        get_box_sizes(blur_level)
+
+def set_perturb_cache(cache):
+    global perturb_cache
+
+    perturb_cache = cache
+
+def set_combined_frac(frac):
+    global combined_frac
+
+    assert 0. <= frac <= 1., f"combined_frac has to be in [0, 1], got {frac}"
+    combined_frac = frac
+
+def blur_image(image, blur_level=7, backend=None, dst=None):
+    # Gaussian blur of an HWC image with the given (odd) kernel size, using the selected backend. Written to dst if given
+    if backend is None:
+        backend = blur_backend
+
+    if perturb_cache is not None:
+        return perturb_cache.get_or_compute(image, f"blur_{backend}", blur_level, partial(compute_blur, image, blur_level, backend))
+
+    return compute_blur(image, blur_level, backend, dst)
+
+def compute_blur(image, blur_level, backend, dst=None):
+    if backend == "box" and blur_level >= BOX_BLUR_MIN_LEVEL:
+        for box_size in get_box_sizes(blur_level):
+            image = cv2.blur(image, (box_size, box_size), dst=dst, borderType=cv2.BORDER_REFLECT_101)
+        return image
+
+    if backend == "separable" or backend == "box":
+        kernel = get_gaussian_kernel(blur_level)
+        return cv2.sepFilter2D(image, -1, kernel, kernel, dst=dst, borderType=cv2.BORDER_REFLECT_101)
+
+    return cv2.GaussianBlur(image, (blur_level, blur_level), 0, dst=dst)
+
+def generate_blur_image(image, blur_level=7, backend=None):
     
-    image = cv2.GaussianBlur(image, (blur_level, blur_level), 0)
+    image = blur_image(image, blur_level, backend)
     image = np.moveaxis(image, -1, 0)
 
     return image
 
-def perturb_blur(image, dist_ratio):
+def get_blur_level(dist_ratio):
     blur_level = int(dist_ratio * (107 - 7) + 7)
     if blur_level % 2 == 0: # blur has to be an odd number
         blur_level += 1
-    
-    return generate_blur_image(image, blur_level)
 
-def generate_distort_image(image, distort_level=1):
-     
+    return blur_level
+
+def perturb_blur(image, dist_ratio):
+    return generate_blur_image(image, get_blur_level(dist_ratio))
+
+@lru_cache(maxsize=DISTORT_CACHE_SIZE)
+def get_undistort_maps(height, width, distort_level):
+    '''
+        Builds the remap tables cv2.undistort would compute for this shape and level. cv2.undistort
+        builds its maps in horizontal stripes, shifting the principal point for each one, so the same
+        is done here to get pixel-identical results from cv2.remap.
+    '''
+
     K = np.eye(3)*1000
-    K[0,2] = image.shape[1]/2
-    K[1,2] = image.shape[0]/2
+    K[0,2] = width/2
+    K[1,2] = height/2
     K[2,2] = 1
 
-    image = cv2.undistort(image, K, np.array([distort_level,distort_level,0,0]))
+    dist_coeffs = np.array([distort_level,distort_level,0,0], dtype=np.float64)
+
+    stripe_size = min(max(1, (1 << 12) // max(width, 1)), height)
+    K_stripe = K.copy()
+
+    map1_stripes = []
+    map2_stripes = []
+
+    for y in range(0, height, stripe_size):
+        map1, map2 = cv2.initUndistortRectifyMap(K, dist_coeffs, np.eye(3), K_stripe,
+                                                    (width, min(stripe_size, height - y)), cv2.CV_16SC2)
+        map1_stripes.append(map1)
+        map2_stripes.append(map2)
+
+        K_stripe[1,2] -= stripe_size
+
+    return np.concatenate(map1_stripes), np.concatenate(map2_stripes)
+
+def distort_image(image, distort_level=1, dst=None):
+    # Same output as cv2.undistort(image, K, [distort_level, distort_level, 0, 0]), HWC in and out. Written to dst if given
+    if perturb_cache is not None:
+        return perturb_cache.get_or_compute(image, "distort", distort_level, partial(compute_distort, image, distort_level))
+
+    return compute_distort(image, distort_level, dst)
+
+def compute_distort(image, distort_level, dst=None):
+    map1, map2 = get_undistort_maps(image.shape[0], image.shape[1], distort_level)
+
+    return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_CONSTANT)
+
+def generate_distort_image(image, distort_level=1):
+
+    image = distort_image(image, distort_level)
     # image = cv2.resize(image, (IMG_WIDTH, IMG_HEIGHT))
     image = np.moveaxis(image, -1, 0)
 
     return image
 
+def get_distort_level(dist_ratio):
+    return int(dist_ratio * (500 - 1) + 1)
+
 def perturb_distort(image, dist_ratio):
-    distort_level = int(dist_ratio * (500 - 1) + 1)
-    return generate_distort_image(image, distort_level)
+    return generate_distort_image(image, get_distort_level(dist_ratio))
+
+
+@lru_cache(maxsize=LUT_CACHE_SIZE)
+def get_channel_lut(max_val, direction, dist_ratio):
+    '''
+        Table of what every uint8 channel value becomes when lowered (direction 4) or raised (direction 5)
+        by dist_ratio. Uses the same float64 arithmetic and truncation as scaling the channel directly.
+    '''
+
+    values = np.arange(256) * (1-dist_ratio)
+    if direction == 5:
+        values = values + (max_val * dist_ratio)
 
+    lut = values.astype(np.uint8)
+    lut.flags.writeable = False
+
+    return lut
+
+def quantize_ratio(dist_ratio):
+    return round(float(dist_ratio) * LUT_RATIO_STEPS) / LUT_RATIO_STEPS
+
+def apply_channel_lut(image, channel, lut):
+    # Maps one channel of an HWC uint8 image through the table, in place. cv2.LUT is a lot faster on a contiguous plane
+    plane = np.ascontiguousarray(image[:, :, channel])
+    image[:, :, channel] = cv2.LUT(plane, lut, dst=plane)
 
 def generate_RGB_image(image, channel, direction, dist_ratio=0.25):
 
@@ -90,11 +320,9 @@ def generate_RGB_image(image, channel, direction, dist_ratio=0.25):
         1: "G", 
         2: "B"
     }
-                   
-    if direction == 4: # lower the channel value
-        image[:, :, channel] = (image[:, :, channel] * (1-dist_ratio)) + (0 * dist_ratio)
-    else: # raise the channel value
-        image[:, :, channel] = (image[:, :, channel] * (1-dist_ratio)) + (RGB_MAX * dist_ratio)
+
+    # lowering the channel value for direction 4, raising it otherwise
+    apply_channel_lut(image, channel, get_channel_lut(RGB_MAX, 4 if direction == 4 else 5, dist_ratio))
 
     # added nov 10
     # image = cv2.resize(image, (IMG_WIDTH, IMG_HEIGHT))
@@ -144,11 +372,8 @@ def generate_HSV_image(image, channel, direction, dist_ratio=0.25):
     if channel == 0:
         max_val = HSV_H_MAX
 
-    if direction == 4:
-        image[:, :, channel] = (image[:, :, channel] * (1-dist_ratio))
-    if direction == 5:
-        image[:, :, channel] = (image[:, :, channel] * (1-dist_ratio)) + (max_val * dist_ratio)
-
+    if direction == 4 or direction == 5:
+        apply_channel_lut(image, channel, get_channel_lut(max_val, direction, dist_ratio))
 
     image = cv2.cvtColor(image, cv2.COLOR_HSV2RGB)
     # image = cv2.resize(image, (IMG_WIDTH, IMG_HEIGHT))
@@ -186,21 +411,37 @@ def perturb_v_high(image, dist_ratio):
 def clean(image, dist_ratio):
     return np.moveaxis(image, -1, 0)
 
+# The single perturbations a combined image is blended from, and how many rounds of blending it gets
+COMBINE_METHODS = [perturb_r_low, perturb_r_high, perturb_b_low, perturb_b_high, perturb_g_low, perturb_g_high, 
+                    perturb_h_low, perturb_h_high, perturb_s_low, perturb_s_high, perturb_v_low, perturb_v_high,
+                    perturb_blur, perturb_noise, perturb_distort]
+COMBINE_ROUNDS = 3
+
+def average_into(a, b, scratch=None):
+    # a = (a + b) // 2 in place for uint8 arrays, what np.uint8(np.mean([a, b], axis=0)) gives without leaving uint8
+    carry = np.bitwise_and(a, b, out=scratch)
+    carry &= 1
+    a >>= 1
+    a += carry
+    a += np.right_shift(b, 1, out=carry)
+
+    return a
+
 def combine(img, dist_ratio):
     dist_ratio = dist_ratio / 2
 
-    methods = [perturb_r_low, perturb_r_high, perturb_b_low, perturb_b_high, perturb_g_low, perturb_g_high, 
-                perturb_h_low, perturb_h_high, perturb_s_low, perturb_s_high, perturb_v_low, perturb_v_high,
-                perturb_blur, perturb_noise, perturb_distort]
-
     img_clean = img.copy()
+    img = np.ascontiguousarray(np.moveaxis(img, -1, 0))
+    scratch = np.empty_like(img)
     
-    for i in range(3):
-        aug_img = methods[np.random.randint(0, high=len(methods))](img_clean.copy(), dist_ratio)
-        aug_img = np.moveaxis(aug_img, 0, -1)
-        img = np.uint8(np.mean([img, aug_img], axis=0))
+    for i in range(COMBINE_ROUNDS):
+        aug_img = COMBINE_METHODS[np.random.randint(0, high=len(COMBINE_METHODS))](img_clean.copy(), dist_ratio)
 
-    img = np.moveaxis(img, -1,0)
+        if aug_img.dtype == np.uint8:
+            average_into(img, aug_img, scratch)
+        else:
+            # The noise is averaged before it is clipped to uint8
+            img = np.uint8(np.mean([img, aug_img], axis=0))
 
     return img
 
@@ -217,8 +458,206 @@ def generate_random_image(img, curriculum_max):
     return aug_img
 
 
-def generate_augmentations_batch(image_batch, curriculum_max):
-    aug_imgs = []
+'''
+    Batched versions of the single perturbations. Each one takes a (N, H, W, C) uint8 batch and an
+    array of N intensities and returns the (N, C, H, W) uint8 batch the per-image methods would give.
+'''
+
+def get_scratch(name, shape, dtype=np.uint8):
+    # Work buffer kept between calls, only reallocated when the shape or dtype changes (e.g. the last, smaller batch)
+    buffer = scratch_buffers.get(name)
+
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        scratch_buffers[name] = buffer
+
+    return buffer
+
+def get_batch_out(images, out):
+    # The (N, C, H, W) uint8 array a batched kernel writes to, allocated if the caller doesn't pass one
+    if out is None:
+        out = np.empty((images.shape[0], images.shape[3], images.shape[1], images.shape[2]), dtype=np.uint8)
+
+    return out
+
+def batch_RGB(images, channel, direction, dist_ratios, out=None, indices=None):
+    out = get_batch_out(images, out)
+    lut_direction = 4 if direction == 4 else 5
+
+    for i in range(len(images)) if indices is None else indices:
+        # One transposing copy into the output, then the channel (a contiguous plane in CHW) is mapped in place
+        out[i] = images[i].transpose(2, 0, 1)
+        cv2.LUT(out[i, channel], get_channel_lut(RGB_MAX, lut_direction, quantize_ratio(dist_ratios[i])), dst=out[i, channel])
+
+    return out
+
+def batch_HSV(images, channel, direction, dist_ratios, out=None, indices=None):
+    out = get_batch_out(images, out)
+    hsv = get_scratch("hsv", images.shape[1:])
+    plane = get_scratch("hsv_plane", images.shape[1:3])
+    rgb = get_scratch("rgb", images.shape[1:])
+
+    max_val = HSV_SV_MAX
+    if channel == 0:
+        max_val = HSV_H_MAX
+
+    for i in range(len(images)) if indices is None else indices:
+        cv2.cvtColor(images[i], cv2.COLOR_RGB2HSV, dst=hsv)
+
+        if direction == 4 or direction == 5:
+            np.copyto(plane, hsv[:, :, channel])
+            cv2.LUT(plane, get_channel_lut(max_val, direction, quantize_ratio(dist_ratios[i])), dst=plane)
+            hsv[:, :, channel] = plane
+
+        cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=rgb)
+        out[i] = rgb.transpose(2, 0, 1)
+
+    return out
+
+def batch_noise(images, dist_ratios, rngs=None, out=None, indices=None):
+    '''
+        rngs optionally holds one generator per image of the batch, otherwise the noise is drawn from np.random
+        in image order, the same draws as the per-image np.random.normal.
+    '''
+
+    out = get_batch_out(images, out)
+    indices = range(len(images)) if indices is None else indices
+    noise_levels = (np.asarray(dist_ratios) * (200 - 20) + 20).astype(np.int64)
+
+    noisy = get_scratch("noise_f32", images.shape[1:], np.float32)
+
+    if noise_backend == "bank":
+        bank = get_noise_bank()
+        offsets = bank.draw_offsets(int(np.prod(images.shape[1:])), len(indices), None if rngs is None else [rngs[i] for i in indices])
+
+        for offset, i in zip(offsets, indices):
+            # float32 throughout, no float64 temporaries
+            np.multiply(bank.window(offset, images.shape[1:]), np.float32(noise_levels[i]), out=noisy)
+            noisy += images[i]
+            out[i] = noisy.transpose(2, 0, 1)
+
+        return out
+
+    gauss = get_scratch("noise_f64", images.shape[1:], np.float64)
+
+    for i in indices:
+        # np.random has no out argument, the generators do
+        if rngs is None:
+            gauss[...] = np.random.standard_normal(images.shape[1:])
+        else:
+            rngs[i].standard_normal(out=gauss)
+
+        gauss *= noise_levels[i]
+        gauss += images[i]
+        np.copyto(noisy, gauss, casting='unsafe') # through float32 like the per-image version
+        out[i] = noisy.transpose(2, 0, 1)
+
+    return out
+
+def batch_blur(images, dist_ratios, out=None, indices=None):
+    # The kernel size changes per image, so this one stays a loop
+    out = get_batch_out(images, out)
+    blurred = get_scratch("filter", images.shape[1:])
+
+    for i in range(len(images)) if indices is None else indices:
+        out[i] = blur_image(images[i], get_blur_level(dist_ratios[i]), dst=blurred).transpose(2, 0, 1)
+
+    return out
+
+def batch_distort(images, dist_ratios, out=None, indices=None):
+    # The camera distortion changes per image, so this one stays a loop
+    out = get_batch_out(images, out)
+    distorted = get_scratch("filter", images.shape[1:])
+
+    for i in range(len(images)) if indices is None else indices:
+        out[i] = distort_image(images[i], get_distort_level(dist_ratios[i]), dst=distorted).transpose(2, 0, 1)
+
+    return out
+
+# Maps each single perturbation to the batched version used by generate_augmentations_batch
+BATCH_METHODS = {
+    perturb_r_low: partial(batch_RGB, channel=0, direction=4),
+    perturb_r_high: partial(batch_RGB, channel=0, direction=5),
+    perturb_g_low: partial(batch_RGB, channel=1, direction=4),
+    perturb_g_high: partial(batch_RGB, channel=1, direction=5),
+    perturb_b_low: partial(batch_RGB, channel=2, direction=4),
+    perturb_b_high: partial(batch_RGB, channel=2, direction=5),
+    perturb_h_low: partial(batch_HSV, channel=0, direction=4),
+    perturb_h_high: partial(batch_HSV, channel=0, direction=5),
+    perturb_s_low: partial(batch_HSV, channel=1, direction=4),
+    perturb_s_high: partial(batch_HSV, channel=1, direction=5),
+    perturb_v_low: partial(batch_HSV, channel=2, direction=4),
+    perturb_v_high: partial(batch_HSV, channel=2, direction=5),
+    perturb_noise: batch_noise,
+    perturb_blur: batch_blur,
+    perturb_distort: batch_distort
+}
+
+'''
+    Counter-based random numbers for the training perturbations. A sample's generator is Philox keyed by the
+    seed, with the sample index and the epoch in the high words of the counter, so what a sample draws only
+    depends on (seed, epoch, index) and not on the worker or the batch it is loaded in. The generators only
+    advance the lowest word, so the streams of different samples never overlap.
+'''
+
+# Streams in the second word of the counter
+SAMPLE_STREAM = 0
+METHOD_ORDER_STREAM = 1
+
+def get_counter_rng(seed, epoch, index, stream=SAMPLE_STREAM):
+    return np.random.Generator(np.random.Philox(key=seed, counter=[0, stream, index, epoch]))
+
+def get_method_order(seed, epoch, num_methods):
+    # Permutation of the methods for the epoch, sample i gets order[i % num_methods] so the methods are spread evenly
+    return get_counter_rng(seed, epoch, 0, METHOD_ORDER_STREAM).permutation(num_methods)
+
+def combine_batch(images, dist_ratios, rngs=None, out=None, indices=None):
+    '''
+        Batched combine(): every image is blended COMBINE_ROUNDS times with a single perturbation of its clean
+        version at half its intensity. Each round runs one batched kernel per method and averages in place in
+        uint8. The methods are drawn per round for the whole batch, so from np.random this doesn't give the
+        same images as calling combine() per image, from the per-image generators in rngs it is independent
+        of the batching.
+    '''
+
+    out = get_batch_out(images, out)
+    indices = np.arange(len(images)) if indices is None else np.asarray(indices, dtype=np.int64)
+    half_ratios = np.asarray(dist_ratios, dtype=np.float64) / 2
+    noise_levels = (half_ratios * (200 - 20) + 20).astype(np.int64)
+
+    aug_imgs = get_scratch("combine_aug", out.shape)
+    carry = get_scratch("combine_carry", out.shape[1:])
+    blended = get_scratch("combine_f32", out.shape[1:], np.float32)
+
+    for i in indices:
+        out[i] = images[i].transpose(2, 0, 1)
+
+    for round in range(COMBINE_ROUNDS):
+        if rngs is None:
+            choices = np.random.randint(0, len(COMBINE_METHODS), size=len(indices))
+        else:
+            choices = np.asarray([rngs[i].integers(0, len(COMBINE_METHODS)) for i in indices], dtype=np.int64)
+
+        for choice in np.unique(choices):
+            method = COMBINE_METHODS[choice]
+            selected = indices[choices == choice]
+
+            if method is perturb_noise:
+                # The noise is averaged before it is clipped to uint8, like combine() does
+                for i in selected:
+                    noisy = add_noise(images[i], noise_levels[i], None if rngs is None else rngs[i])
+                    np.add(out[i], noisy.transpose(2, 0, 1), out=blended)
+                    blended /= 2
+                    np.copyto(out[i], blended, casting='unsafe')
+                continue
+
+            BATCH_METHODS[method](images, dist_ratios=half_ratios, out=aug_imgs, indices=selected)
+            for i in selected:
+                average_into(out[i], aug_imgs[i], carry)
+
+    return out
+
+def generate_augmentations_batch(image_batch, curriculum_max, sample_keys=None, out=None):
 
     '''
         The following comment blocks should be commented and uncommented based on the test
@@ -272,141 +711,338 @@ def generate_augmentations_batch(image_batch, curriculum_max):
     # Only HSV 
     # methods = [perturb_h_low, perturb_h_high, perturb_s_low, perturb_s_high, perturb_v_low, perturb_v_high]
     
-    # Augmenting the images with single perturbations
-    for i in range(len(image_batch)):
-        image = image_batch[i]
-        intensity = np.random.uniform(low=0.0, high=curriculum_max)
-        
+    if sample_keys is None:
+        rngs = None
+
+        # Drawing every image's intensity up front
+        intensities = np.random.uniform(low=0.0, high=curriculum_max, size=len(image_batch))
+
         # Static Intensities 
-        # intensity = random.choice([0.02, 0.2, 0.5, 0.65, 1.0])
+        # intensities = np.asarray([random.choice([0.02, 0.2, 0.5, 0.65, 1.0]) for i in range(len(image_batch))])
 
-        if i % len(methods) == 0:
-            random.shuffle(methods)
-    
-        aug_imgs.append(np.uint8(methods[i%len(methods)](image.copy(), intensity)))
-    
-    aug_imgs = np.asarray(aug_imgs)
+        # Assigning the single perturbations to the images, reshuffling the methods every full cycle
+        assigned = []
+        for i in range(len(image_batch)):
+            if i % len(methods) == 0:
+                random.shuffle(methods)
 
-    # Augmenting a random sampling of the batch with combined perturbations through averaging other images
-    # combined_imgs_index = np.random.choice(len(aug_imgs), int((len(image_batch)/10)), replace=False)
-    # # print(f"combined imgs index: {combined_imgs_index}")
-    # for j in range(len(combined_imgs_index)):
-    #     selected_imgs_index = np.random.randint(0, len(aug_imgs), size=2)
-    #     # print(f"selected imgs index: {selected_imgs_index}")
+            assigned.append(methods[i%len(methods)])
+    else:
+        # sample_keys is (seed, epoch, sample indices), everything is drawn from the samples' counter-based generators
+        seed, epoch, sample_indices = sample_keys
+        rngs = [get_counter_rng(seed, epoch, int(index)) for index in sample_indices]
 
-    #     aug_imgs[combined_imgs_index[j]] = np.uint8(np.mean(np.array([aug_imgs[combined_imgs_index[j]], aug_imgs[selected_imgs_index[0]], aug_imgs[selected_imgs_index[1]]]), axis=0))        
+        intensities = np.asarray([rng.uniform(0.0, curriculum_max) for rng in rngs])
+
+        order = get_method_order(seed, epoch, len(methods))
+        assigned = [methods[order[int(index) % len(methods)]] for index in sample_indices]
+
+    # A combined_frac share of the images gets a combined perturbation instead of its single one (see set_combined_frac)
+    combined = []
+    if combined_frac > 0:
+        if rngs is None:
+            combined = np.flatnonzero(np.random.random(len(image_batch)) < combined_frac)
+        else:
+            combined = np.flatnonzero([rng.random() < combined_frac for rng in rngs])
+
+        for i in combined:
+            assigned[i] = combine_batch
+
+    # Written in place into out if given, a (N, C, H, W) uint8 array the caller can reuse between batches
+    aug_imgs = get_batch_out(image_batch, out)
+
+    # Augmenting the images with single perturbations, one call per method for all of the images assigned to it
+    for method in methods:
+        indices = np.asarray([i for i in range(len(image_batch)) if assigned[i] is method], dtype=np.int64)
+
+        if len(indices) == 0:
+            continue
+
+        if method is perturb_noise:
+            batch_noise(image_batch, dist_ratios=intensities, rngs=rngs, out=aug_imgs, indices=indices)
+        elif method in BATCH_METHODS:
+            BATCH_METHODS[method](image_batch, dist_ratios=intensities, out=aug_imgs, indices=indices)
+        else:
+            for i in indices:
+                aug_imgs[i] = np.uint8(method(image_batch[i].copy(), intensities[i]))
+
+    if len(combined) > 0:
+        combine_batch(image_batch, intensities, rngs=rngs, out=aug_imgs, indices=combined)
 
     return aug_imgs
 
-def generate_augmentations_test(image, aug_method, aug_level):
-    
-    image_copy = image.copy()
-
-    rgb_dark_light = {
-        0: [2, 4],
-        1: [2, 5],
-        2: [1, 4],
-        3: [1, 5],
-        4: [0, 4],
-        5: [0, 5]
-    }
+'''
+    Batched generators for the combined and unseen test perturbations (combined, compression, pixelate, fog,
+    frost, snow, motion_blur and zoom_blur), so those test sets can be rendered from the clean frames instead
+    of read from pre-rendered folders. The unseen ones follow the ImageNet-C corruptions (Hendrycks and
+    Dietterich) and their level parameters. Each one takes a (N, H, W, C) uint8 batch, a level from 1 and one
+    np.random.Generator per image, and returns the (N, C, H, W) uint8 batch. All of the randomness of an image
+    comes from its own generator, so it is rendered the same way whatever batch or worker it ends up in.
+'''
 
-    dark_light = {
-        0: [0, 4],
-        1: [0, 5],
-        2: [1, 4],
-        3: [1, 5],
-        4: [2, 4],
-        5: [2, 5]
-    }
+COMBINED_LVL = [1/6, 2/6, 3/6, 4/6, 5/6, 1.0] # intensity passed to combine()
+COMPRESSION_LVL = [25, 18, 15, 10, 7] # JPEG quality
+PIXELATE_LVL = [0.6, 0.5, 0.4, 0.3, 0.25] # downscaling factor
+FOG_LVL = [(1.5, 2), (2., 2), (2.5, 1.7), (2.5, 1.5), (3., 1.4)] # fog strength, fractal decay
+FROST_LVL = [(1, 0.4), (0.8, 0.6), (0.7, 0.7), (0.65, 0.7), (0.6, 0.75)] # image weight, frost weight
+SNOW_LVL = [(0.1, 0.3, 3, 0.5, 10, 4, 0.8), # flake mean, flake std, zoom, threshold, blur radius, blur sigma, image weight
+            (0.2, 0.3, 2, 0.5, 12, 4, 0.7),
+            (0.55, 0.3, 4, 0.9, 12, 8, 0.7),
+            (0.55, 0.3, 4.5, 0.85, 12, 8, 0.65),
+            (0.55, 0.3, 2.5, 0.85, 12, 12, 0.55)]
+MOTION_BLUR_LVL = [(10, 3), (15, 5), (15, 8), (15, 12), (20, 15)] # blur radius, blur sigma
+ZOOM_BLUR_LVL = [np.arange(1, 1.11, 0.01), np.arange(1, 1.16, 0.01), np.arange(1, 1.21, 0.02),
+                 np.arange(1, 1.26, 0.02), np.arange(1, 1.31, 0.03)] # zoom factors that are averaged
+
+# ImageNet-C reads its frost from photos, which aren't shipped here, so a rough fractal with a cold tint stands in
+FROST_DECAY = 1.3
+FROST_TINT = np.array([0.85, 0.93, 1.0], dtype=np.float32)
+
+CV_MAX_CHANNELS = 512
+
+def to_chw_uint8(images):
+    # (N, H, W, C) float in [0, 255] to a contiguous (N, C, H, W) uint8 batch
+    return np.ascontiguousarray(np.moveaxis(images.astype(np.uint8), -1, 1))
+
+def resize_batch(images, size, interpolation):
+    # Resizes (N, H, W, C) images to size (width, height) by stacking them along the channels, one cv2 call per chunk
+    n, h, w, c = images.shape
+    # INTER_AREA only takes up to 4 channels unless the scale is an integer. Float results round differently
+    # with the number of channels, so those go one image at a time to not depend on the rest of the batch
+    if images.dtype != np.uint8:
+        step = 1
+    else:
+        step = max(1, (4 if interpolation == cv2.INTER_AREA else CV_MAX_CHANNELS) // c)
+    resized = []
+
+    for i in range(0, n, step):
+        chunk = images[i:i+step]
+        stacked = np.ascontiguousarray(chunk.transpose(1, 2, 0, 3).reshape(h, w, -1))
+        stacked = cv2.resize(stacked, size, interpolation=interpolation)
+        resized.append(stacked.reshape(size[1], size[0], len(chunk), c).transpose(2, 0, 1, 3))
+
+    return np.concatenate(resized)
+
+def clipped_zoom_batch(images, zoom):
+    # Zooms into the center of each image by the given factor, keeping the size
+    h, w = images.shape[1:3]
+    crop_h, crop_w = int(np.ceil(h / zoom)), int(np.ceil(w / zoom))
+    top, left = (h - crop_h) // 2, (w - crop_w) // 2
+
+    return resize_batch(images[:, top:top+crop_h, left:left+crop_w], (w, h), cv2.INTER_LINEAR)
+
+def get_motion_blur_kernel(radius, sigma, angle):
+    # Line trailing off from the center at angle (degrees) with Gaussian weights, like ImageMagick's motion blur
+    size = 2*radius + 1
+    kernel = np.zeros((size, size), dtype=np.float32)
+
+    t = np.arange(radius + 1)
+    xs = np.rint(radius + t*np.cos(np.deg2rad(angle))).astype(int)
+    ys = np.rint(radius - t*np.sin(np.deg2rad(angle))).astype(int)
+    np.add.at(kernel, (ys, xs), np.exp(-t**2 / (2*sigma**2)))
+
+    return kernel / kernel.sum()
+
+def plasma_fractal_batch(rngs, mapsize=256, wibbledecay=3):
+    '''
+        Diamond-square fractals in [0, 1] of shape (N, mapsize, mapsize), one per generator. mapsize has
+        to be a power of 2. Same algorithm as ImageNet-C, with the images of the batch filled in together.
+    '''
 
-    rgb_hsv_levels = {
-        "1": 0.02,
-        "2": 0.2,
-        "3": 0.5,
-        "4": 0.65,
-        "5": 1.0
-    }
+    maparray = np.zeros((len(rngs), mapsize, mapsize), dtype=np.float64)
+    stepsize = mapsize
+    wibble = 100
 
-    if aug_method == "R lighter":
-        values = rgb_dark_light[5]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
- 
-    if aug_method == "R darker":
-        values = rgb_dark_light[4]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
+    def wibbledmean(array):
+        return array / 4 + wibble * np.stack([rng.uniform(-wibble, wibble, array.shape[1:]) for rng in rngs])
 
-    if aug_method == "G lighter":
-        values = rgb_dark_light[3]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
+    while stepsize >= 2:
+        half = stepsize // 2
 
-    if aug_method == "G darker":
-        values = rgb_dark_light[2]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
+        # squares
+        cornerref = maparray[:, 0::stepsize, 0::stepsize]
+        squareaccum = cornerref + np.roll(cornerref, -1, axis=1)
+        squareaccum += np.roll(squareaccum, -1, axis=2)
+        maparray[:, half::stepsize, half::stepsize] = wibbledmean(squareaccum)
 
-    if aug_method == "B lighter":
-        values = rgb_dark_light[1]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
+        # diamonds
+        drgrid = maparray[:, half::stepsize, half::stepsize]
+        ulgrid = maparray[:, 0::stepsize, 0::stepsize]
+        ltsum = drgrid + np.roll(drgrid, 1, axis=1) + ulgrid + np.roll(ulgrid, -1, axis=2)
+        maparray[:, 0::stepsize, half::stepsize] = wibbledmean(ltsum)
+        ttsum = drgrid + np.roll(drgrid, 1, axis=2) + ulgrid + np.roll(ulgrid, -1, axis=1)
+        maparray[:, half::stepsize, 0::stepsize] = wibbledmean(ttsum)
 
-    if aug_method == "B darker":
-        values = rgb_dark_light[0]
-        noise_image = generate_RGB_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
+        stepsize //= 2
+        wibble /= wibbledecay
 
-    if aug_method == "H darker":
-        values = dark_light[0]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-    
-    if aug_method == "H lighter":
-        values = dark_light[1]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-    
-    if aug_method == "S darker":
-        values = dark_light[2]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-    
-    if aug_method == "S lighter":
-        values = dark_light[3]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-
-    if aug_method == "V darker":
-        values = dark_light[4]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-
-    if aug_method == "V lighter":
-        values = dark_light[5]
-        noise_image = generate_HSV_image(image_copy, values[0], values[1], dist_ratio=rgb_hsv_levels[aug_level])
-
-    blur_levels = {
-        "1": 7,
-        "2": 17,
-        "3": 37,
-        "4": 67,
-        "5": 107
-    }
+    maparray -= maparray.min(axis=(1, 2), keepdims=True)
 
-    noise_levels = {
-        "1": 20,
-        "2": 50,
-        "3": 100,
-        "4": 150,
-        "5": 200 
-    }
+    return maparray / maparray.max(axis=(1, 2), keepdims=True)
 
-    distort_levels = {
-        "1": 1,
-        "2": 10,
-        "3": 50,
-        "4": 200,
-        "5": 500
-    }
+def get_fractal_size(height, width):
+    return 1 << int(np.ceil(np.log2(max(height, width))))
 
-    if aug_method == "blur":
-        noise_image = generate_blur_image(image_copy, blur_levels[aug_level])
+def batch_combined(images, level, rngs):
+    dist_ratio = COMBINED_LVL[level-1]
 
-    if aug_method == "noise":
-        noise_image = generate_noise_image(image_copy, noise_levels[aug_level])
-    
-    if aug_method == "distort":
-        noise_image = generate_distort_image(image_copy, distort_levels[aug_level])
+    return combine_batch(images, np.full(len(images), dist_ratio), rngs=rngs)
+
+def batch_compression(images, level, rngs):
+    quality = COMPRESSION_LVL[level-1]
+    out = np.empty_like(images)
+
+    for i in range(len(images)):
+        # cv2 encodes BGR, so the channels are swapped around the round trip to get the right chroma
+        _, buffer = cv2.imencode(".jpg", cv2.cvtColor(images[i], cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        out[i] = cv2.cvtColor(cv2.imdecode(buffer, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    return np.ascontiguousarray(np.moveaxis(out, -1, 1))
+
+def batch_pixelate(images, level, rngs):
+    h, w = images.shape[1:3]
+    scale = PIXELATE_LVL[level-1]
+
+    small = resize_batch(images, (int(w*scale), int(h*scale)), cv2.INTER_AREA)
+
+    return np.ascontiguousarray(np.moveaxis(resize_batch(small, (w, h), cv2.INTER_NEAREST), -1, 1))
+
+def batch_fog(images, level, rngs):
+    strength, decay = FOG_LVL[level-1]
+    h, w = images.shape[1:3]
+
+    x = images.astype(np.float32) / 255.
+    max_val = x.max(axis=(1, 2, 3), keepdims=True)
+
+    x += strength * plasma_fractal_batch(rngs, get_fractal_size(h, w), decay)[:, :h, :w, None].astype(np.float32)
+
+    return to_chw_uint8(np.clip(x * max_val / (max_val + strength), 0, 1) * 255)
+
+def batch_frost(images, level, rngs):
+    image_weight, frost_weight = FROST_LVL[level-1]
+    h, w = images.shape[1:3]
+
+    frost = plasma_fractal_batch(rngs, get_fractal_size(h, w), FROST_DECAY)[:, :h, :w, None].astype(np.float32)
+    frost = frost * FROST_TINT * 255
+
+    return to_chw_uint8(np.clip(image_weight * images.astype(np.float32) + frost_weight * frost, 0, 255))
+
+def batch_snow(images, level, rngs):
+    loc, scale, zoom, threshold, radius, sigma, image_weight = SNOW_LVL[level-1]
+    h, w = images.shape[1:3]
+
+    x = images.astype(np.float32) / 255.
+
+    snow = np.stack([rng.normal(loc, scale, (h, w)) for rng in rngs]).astype(np.float32)
+    snow = clipped_zoom_batch(snow[..., None], zoom)[..., 0]
+    snow[snow < threshold] = 0
+
+    # Each image's flakes fall at their own angle
+    for i in range(len(images)):
+        kernel = get_motion_blur_kernel(radius, sigma, rngs[i].uniform(-135, -45))
+        snow[i] = cv2.filter2D(snow[i], -1, kernel, borderType=cv2.BORDER_REPLICATE)
+    snow = snow[..., None]
+
+    gray = (x @ np.array([0.299, 0.587, 0.114], dtype=np.float32))[..., None]
+    x = image_weight * x + (1 - image_weight) * np.maximum(x, gray * 1.5 + 0.5)
+
+    return to_chw_uint8(np.clip(x + snow + np.rot90(snow, k=2, axes=(1, 2)), 0, 1) * 255)
+
+def batch_motion_blur(images, level, rngs):
+    radius, sigma = MOTION_BLUR_LVL[level-1]
+    out = np.empty_like(images)
+
+    for i in range(len(images)):
+        kernel = get_motion_blur_kernel(radius, sigma, rngs[i].uniform(-45, 45))
+        out[i] = cv2.filter2D(images[i], -1, kernel, borderType=cv2.BORDER_REPLICATE)
+
+    return np.ascontiguousarray(np.moveaxis(out, -1, 1))
+
+def batch_zoom_blur(images, level, rngs):
+    # Zooming the uint8 frames, which can be resized as one stack
+    out = images.astype(np.float32)
+
+    for zoom in ZOOM_BLUR_LVL[level-1]:
+        out += clipped_zoom_batch(images, zoom)
+
+    return to_chw_uint8(out / (len(ZOOM_BLUR_LVL[level-1]) + 1))
+
+'''
+    Registry of the test perturbations, mapping each aug_list_all.txt name (e.g. R_darker_1) to its
+    kernel with the parameters of that level bound in. Every kernel takes an HWC uint8 image and returns
+    the CHW perturbed image. New perturbations are added with register_perturbation, or with
+    register_batch_perturbation for batched generators, which are also kept in BATCH_PERTURBATIONS.
+'''
+
+PERTURBATIONS = {}
+BATCH_PERTURBATIONS = {}
+
+# level values of the test sets, the RGB/HSV ones go one past RGB_LVL
+TEST_RGB_HSV_LVL = [0.02, 0.2, 0.5, 0.65, 1.0]
+
+def register_perturbation(name, kernel, **params):
+    PERTURBATIONS[name] = partial(kernel, **params)
+
+def render_single(image, batch_kernel, **params):
+    # One image through a batched generator, its generator is drawn from np.random so the global seed still applies
+    rng = np.random.default_rng(np.random.randint(2**31))
+
+    return batch_kernel(image[None], rngs=[rng], **params)[0]
+
+def register_batch_perturbation(name, batch_kernel, **params):
+    BATCH_PERTURBATIONS[name] = partial(batch_kernel, **params)
+    register_perturbation(name, render_single, batch_kernel=batch_kernel, **params)
+
+def get_perturbation(name):
+    if name not in PERTURBATIONS:
+        raise KeyError(f"Unknown perturbation {name}")
+
+    return PERTURBATIONS[name]
+
+def render_perturbation_batch(images, name, seeds):
+    '''
+        Renders the batched perturbation name over a (N, H, W, C) uint8 batch, returning (N, C, H, W) uint8.
+        seeds holds one seed per image (an int or a sequence of ints, e.g. (seed, test_num, index)).
+    '''
+
+    if name not in BATCH_PERTURBATIONS:
+        raise KeyError(f"No batched generator for perturbation {name}")
+
+    return BATCH_PERTURBATIONS[name](images, rngs=[np.random.default_rng(seed) for seed in seeds])
+
+def register_test_perturbations():
+    for level in range(1, 6):
+        dist_ratio = TEST_RGB_HSV_LVL[level-1]
+
+        for channel, name in enumerate(["R", "G", "B"]):
+            register_perturbation(f"{name}_darker_{level}", generate_RGB_image, channel=channel, direction=4, dist_ratio=dist_ratio)
+            register_perturbation(f"{name}_lighter_{level}", generate_RGB_image, channel=channel, direction=5, dist_ratio=dist_ratio)
+
+        for channel, name in enumerate(["H", "S", "V"]):
+            register_perturbation(f"{name}_darker_{level}", generate_HSV_image, channel=channel, direction=4, dist_ratio=dist_ratio)
+            register_perturbation(f"{name}_lighter_{level}", generate_HSV_image, channel=channel, direction=5, dist_ratio=dist_ratio)
+
+        register_perturbation(f"blur_{level}", generate_blur_image, blur_level=BLUR_LVL[level-1])
+        register_perturbation(f"noise_{level}", generate_noise_image, noise_level=NOISE_LVL[level-1])
+        register_perturbation(f"distort_{level}", generate_distort_image, distort_level=DIST_LVL[level-1])
+
+    for level in range(1, 7):
+        register_batch_perturbation(f"combined_{level}", batch_combined, level=level)
+
+    unseen = {"compression": batch_compression, "pixelate": batch_pixelate, "fog": batch_fog, "frost": batch_frost,
+              "snow": batch_snow, "motion_blur": batch_motion_blur, "zoom_blur": batch_zoom_blur}
+
+    for name, batch_kernel in unseen.items():
+        for level in range(1, 6):
+            register_batch_perturbation(f"{name}_{level}", batch_kernel, level=level)
+
+    # the value bound here is the curriculum max rather than a level
+    register_perturbation("random", generate_random_image, curriculum_max=1)
+
+register_test_perturbations()
+
+def generate_augmentations_test(image, aug_method, aug_level):
+    # aug_method and aug_level as split out of the name, e.g. "R darker" and "1"
+    kernel = get_perturbation(f"{aug_method.replace(' ', '_')}_{aug_level}")
 
-    return noise_image
+    return kernel(image.copy())
@@ -0,0 +1,191 @@
+import os
+import hashlib
+import multiprocessing as mp
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.frame_store import get_perturb_code_version
+
+'''
+    Content-addressed cache for the deterministic perturbations. An entry is keyed by a hash of the image
+    pixels together with the perturbation, its intensity bucket (the exact kernel parameter, e.g. the blur
+    size, so a hit gives the same pixels as recomputing) and a seed for perturbations that draw random numbers.
+
+    There are two LRU tiers: a bounded in-RAM one per process, and an optional bounded on-disk one under
+    disk_dir that is shared by the dataloader workers and kept across runs. The disk entries live in a
+    subdirectory named after the version of the perturbation code, so edits to the kernels never serve
+    stale pixels.
+'''
+
+COUNTERS = ["ram_hits", "disk_hits", "misses", "ram_evictions", "disk_evictions"]
+
+# The disk tier is trimmed down to this fraction of its budget, so eviction doesn't run on every write
+DISK_LOW_WATER = 0.9
+
+class PerturbCache:
+    def __init__(self, ram_bytes=256 << 20, disk_dir=None, disk_bytes=0):
+        self.ram_bytes = ram_bytes
+        self.ram = OrderedDict()
+        self.ram_used = 0
+
+        self.disk_bytes = disk_bytes
+        self.disk_dir = None
+        if disk_dir and disk_bytes > 0:
+            self.disk_dir = os.path.join(disk_dir, get_perturb_code_version())
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        # Both are shared with the dataloader workers forked after this, and locked since they all write to them,
+        # so the disk budget and the counts cover every process
+        self.disk_used = mp.Value('q', self.scan_disk_usage())
+        self.counters = mp.Array('q', len(COUNTERS))
+
+    @staticmethod
+    def make_key(image, perturb, bucket, seed=None):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(image).data)
+        h.update(f"{image.shape}|{image.dtype}|{perturb}|{bucket}|{seed}".encode())
+
+        return h.hexdigest()
+
+    def count(self, name):
+        with self.counters.get_lock():
+            self.counters[COUNTERS.index(name)] += 1
+
+    def get_disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".npy")
+
+    def scan_disk_usage(self):
+        if self.disk_dir is None:
+            return 0
+
+        return sum(size for path, size, mtime in self.list_disk_entries())
+
+    def list_disk_entries(self):
+        # (path, size, mtime) of every entry, the other processes write to the same directory
+        entries = []
+
+        for root, dirs, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith(".npy"):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # evicted by another process in the meantime
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def put_ram(self, key, value):
+        if value.nbytes > self.ram_bytes:
+            return
+
+        self.ram[key] = value
+        self.ram_used += value.nbytes
+
+        while self.ram_used > self.ram_bytes:
+            old_key, old_value = self.ram.popitem(last=False)
+            self.ram_used -= old_value.nbytes
+            self.count("ram_evictions")
+
+    def put_disk(self, key, value):
+        path = self.get_disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written to a temporary file first so the other processes never read a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, value)
+        with self.disk_used.get_lock():
+            # Renamed under the lock, so an eviction rescanning the directory never counts the entry twice
+            os.replace(tmp_path, path)
+            self.disk_used.value += os.path.getsize(path)
+            over_budget = self.disk_used.value > self.disk_bytes
+
+        if over_budget:
+            self.evict_disk()
+
+    def evict_disk(self):
+        # Least recently used first, the access time is kept in the mtime (see get). The lock is held for the whole
+        # eviction, so the other processes neither evict at the same time nor have their writes lost in the rescan
+        with self.disk_used.get_lock():
+            entries = sorted(self.list_disk_entries(), key=lambda entry: entry[2])
+            disk_used = sum(entry[1] for entry in entries)
+
+            for path, size, mtime in entries:
+                if disk_used <= self.disk_bytes * DISK_LOW_WATER:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                disk_used -= size
+                self.count("disk_evictions")
+
+            self.disk_used.value = disk_used
+
+    def get(self, key):
+        if key in self.ram:
+            self.ram.move_to_end(key)
+            self.count("ram_hits")
+            return self.ram[key].copy()
+
+        if self.disk_dir is not None:
+            path = self.get_disk_path(key)
+
+            try:
+                value = np.load(path)
+                os.utime(path)
+            except (FileNotFoundError, ValueError, EOFError): # missing, or evicted while reading
+                value = None
+
+            if value is not None:
+                self.count("disk_hits")
+                self.put_ram(key, value)
+                return value.copy()
+
+        self.count("misses")
+
+        return None
+
+    def put(self, key, value):
+        # A copy, so the caller can keep modifying its own array
+        value = np.array(value, order='C', copy=True)
+
+        self.put_ram(key, value)
+        if self.disk_dir is not None:
+            self.put_disk(key, value)
+
+    def get_or_compute(self, image, perturb, bucket, compute, seed=None):
+        '''
+            Returns the cached output of perturb at bucket for image, calling compute() to make and
+            cache it on a miss. compute has to be a pure function of the key for results not to change.
+        '''
+
+        key = self.make_key(image, perturb, bucket, seed)
+        value = self.get(key)
+
+        if value is None:
+            value = compute()
+            self.put(key, value)
+
+        return value
+
+    def stats(self):
+        with self.counters.get_lock():
+            stats = {name: self.counters[i] for i, name in enumerate(COUNTERS)}
+
+        lookups = stats["ram_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["ram_hits"] + stats["disk_hits"]) / lookups if lookups else 0.
+
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+
+        return (f"ram hits: {stats['ram_hits']}, disk hits: {stats['disk_hits']}, misses: {stats['misses']}, "
+                f"hit rate: {stats['hit_rate']*100:.1f}%, evictions (ram/disk): {stats['ram_evictions']}/{stats['disk_evictions']}")
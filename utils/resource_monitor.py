@@ -0,0 +1,238 @@
+import os
+import csv
+import json
+import time
+import threading
+
+'''
+    Background sampler of the resources used by training, read from /proc so it needs no extra packages
+    (it is disabled on systems without /proc). Every interval seconds it records the parent process and
+    its child processes (the dataloader workers): RSS, PSS, CPU use, threads and open file descriptors,
+    along with the memory still available on the machine and the dataloader queue depths reported by
+    probe. Samples go to resources.csv in logs_dir, and stop() writes resources_summary.json.
+
+    RSS counts the pages shared between the parent and the forked workers (and the batches they hand over
+    through shared memory) once per process, so summing it over the workers overstates the total. PSS
+    splits the shared pages between the processes and sums to what the job really uses.
+'''
+
+COLUMNS = ["time", "epoch", "parent_rss_mb", "parent_pss_mb", "parent_cpu_pct", "parent_threads", "parent_fds",
+           "workers", "workers_rss_mb", "workers_max_rss_mb", "workers_pss_mb", "workers_cpu_pct", "workers_threads",
+           "workers_fds", "total_pss_mb", "mem_available_mb", "loader_outstanding", "loader_ready", "prefetch_ready"]
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def read_proc_status(pid):
+    # VmRSS (MB) and Threads of a process from /proc/<pid>/status
+    rss_mb, threads = 0., 0
+
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss_mb = int(line.split()[1]) / 1024
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+
+    return rss_mb, threads
+
+def read_proc_pss(pid):
+    # PSS in MB from /proc/<pid>/smaps_rollup, 0 on kernels without it
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return 0.
+
+def read_proc_cpu_ticks(pid):
+    # utime + stime of a process, the command name in /proc/<pid>/stat can hold spaces so it is split after it
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+
+    return int(fields[11]) + int(fields[12])
+
+def count_fds(pid):
+    try:
+        return len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        return 0
+
+def get_child_pids(pid):
+    # Direct children of pid, by scanning the parent pid of every process
+    children = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError): # gone in the meantime
+            continue
+
+        if ppid == pid:
+            children.append(int(entry))
+
+    return children
+
+def read_mem_available():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024
+
+    return 0.
+
+class ResourceSampler:
+    def __init__(self, logs_dir, interval=5., probe=None):
+        self.logs_dir = logs_dir
+        self.interval = interval
+
+        # probe() returns the dataloader queue depths (see get_loader_depths in pipeline.py)
+        self.probe = probe
+        self.epoch = 0
+
+        self.enabled = os.path.exists("/proc/self/status")
+        self.pid = os.getpid()
+        self.samples = []
+        self.prev_ticks = {}
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if not self.enabled:
+            print("Resource telemetry needs /proc, it is off on this system")
+            return
+
+        self.csv_path = os.path.join(self.logs_dir, "resources.csv")
+        with open(self.csv_path, 'w', newline='') as f:
+            csv.writer(f).writerow(COLUMNS)
+
+        self.start_time = time.time()
+        self.prev_time = time.time()
+        self.prev_ticks = {self.pid: read_proc_cpu_ticks(self.pid)}
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.record(self.sample())
+            except Exception as e: # telemetry must never take training down
+                print(f"Resource telemetry failed, stopping it: {e}")
+                return
+
+    def get_cpu_pct(self, pid, ticks, elapsed):
+        # Percent of one core since the previous sample, 0 for a process seen for the first time
+        prev = self.prev_ticks.get(pid)
+
+        return 0. if prev is None else 100 * (ticks - prev) / CLOCK_TICKS / elapsed
+
+    def sample(self):
+        now = time.time()
+        elapsed = max(now - self.prev_time, 1e-6)
+        ticks = {}
+
+        parent_rss, parent_threads = read_proc_status(self.pid)
+        ticks[self.pid] = read_proc_cpu_ticks(self.pid)
+
+        sample = {"time": round(now - self.start_time, 3), "epoch": self.epoch,
+                  "parent_rss_mb": parent_rss, "parent_pss_mb": read_proc_pss(self.pid),
+                  "parent_cpu_pct": self.get_cpu_pct(self.pid, ticks[self.pid], elapsed),
+                  "parent_threads": parent_threads, "parent_fds": count_fds(self.pid)}
+
+        workers = dict(workers=0, workers_rss_mb=0., workers_max_rss_mb=0., workers_pss_mb=0., workers_cpu_pct=0.,
+                       workers_threads=0, workers_fds=0)
+
+        for pid in get_child_pids(self.pid):
+            try:
+                rss, threads = read_proc_status(pid)
+                pss = read_proc_pss(pid)
+                ticks[pid] = read_proc_cpu_ticks(pid)
+                fds = count_fds(pid)
+            except OSError: # exited while being read
+                continue
+
+            workers["workers"] += 1
+            workers["workers_rss_mb"] += rss
+            workers["workers_max_rss_mb"] = max(workers["workers_max_rss_mb"], rss)
+            workers["workers_pss_mb"] += pss
+            workers["workers_cpu_pct"] += self.get_cpu_pct(pid, ticks[pid], elapsed)
+            workers["workers_threads"] += threads
+            workers["workers_fds"] += fds
+
+        sample.update(workers)
+        sample["total_pss_mb"] = sample["parent_pss_mb"] + sample["workers_pss_mb"]
+        sample["mem_available_mb"] = read_mem_available()
+
+        depths = self.probe() if self.probe is not None else {}
+        for name in ["loader_outstanding", "loader_ready", "prefetch_ready"]:
+            sample[name] = depths.get(name, -1)
+
+        self.prev_time = now
+        self.prev_ticks = ticks
+
+        return sample
+
+    def record(self, sample):
+        self.samples.append(sample)
+
+        with open(self.csv_path, 'a', newline='') as f:
+            csv.writer(f).writerow([round(sample[column], 3) if isinstance(sample[column], float) else sample[column] for column in COLUMNS])
+
+    def summary(self):
+        if not self.samples:
+            return {}
+
+        def peak(column):
+            sample = max(self.samples, key=lambda s: s[column])
+            return {"value": round(sample[column], 1), "time": sample["time"], "epoch": sample["epoch"]}
+
+        def mean(column):
+            return round(sum(s[column] for s in self.samples) / len(self.samples), 1)
+
+        first, last = self.samples[0], self.samples[-1]
+        hours = max(last["time"] - first["time"], 1e-6) / 3600
+
+        return {"samples": len(self.samples), "interval": self.interval, "duration_s": last["time"],
+                "peak_parent_rss_mb": peak("parent_rss_mb"), "peak_total_pss_mb": peak("total_pss_mb"),
+                "peak_workers_rss_mb": peak("workers_rss_mb"), "peak_workers": peak("workers"),
+                "peak_parent_fds": peak("parent_fds"), "peak_parent_threads": peak("parent_threads"),
+                "min_mem_available_mb": round(min(s["mem_available_mb"] for s in self.samples), 1),
+                "mean_parent_cpu_pct": mean("parent_cpu_pct"), "mean_workers_cpu_pct": mean("workers_cpu_pct"),
+                # A steady climb here over a long run is what ends in the OOM kill
+                "total_pss_growth_mb_per_hour": round((last["total_pss_mb"] - first["total_pss_mb"]) / hours, 1)}
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        # One last sample, so short runs still have something to summarize. This also runs when training failed,
+        # so an error here must not hide that one
+        try:
+            self.record(self.sample())
+        except Exception as e:
+            print(f"Resource telemetry failed to take the last sample: {e}")
+
+        summary = self.summary()
+        if not summary:
+            return summary
+
+        with open(os.path.join(self.logs_dir, "resources_summary.json"), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        print(f"Resources: peak parent RSS {summary['peak_parent_rss_mb']['value']} MB, peak total PSS {summary['peak_total_pss_mb']['value']} MB, "
+              f"peak workers {summary['peak_workers']['value']}, min available {summary['min_mem_available_mb']} MB, "
+              f"PSS growth {summary['total_pss_growth_mb_per_hour']} MB/h")
+
+        return summary
@@ -0,0 +1,48 @@
+import json
+import time
+from contextlib import contextmanager
+
+'''
+    Wall time per stage of the training loop, accumulated over an epoch and written as one JSON line per
+    epoch to train_stages.jsonl next to train_log.txt. It is always on, a stage costs two perf_counter calls.
+
+    Nothing is synchronized with the device, so on CUDA the asynchronous kernels are counted in the stage
+    that next waits on them (e.g. the .item() and .cpu() calls in "sync") rather than in "forward".
+'''
+
+TRAIN_STAGES = ["data_wait", "augment", "transfer", "forward", "backward", "optimizer", "sync",
+                "metrics", "val_data_wait", "val_transfer", "val_forward", "val_sync", "checkpoint", "logging"]
+
+class StageTimer:
+    def __init__(self, stages=TRAIN_STAGES):
+        # Every stage is created up front, the prefetch thread adds to "augment" while the step adds to the rest
+        self.stages = stages
+        self.reset()
+
+    def reset(self):
+        self.totals = dict.fromkeys(self.stages, 0.)
+        self.counts = dict.fromkeys(self.stages, 0)
+
+    def add(self, name, seconds):
+        self.totals[name] += seconds
+        self.counts[name] += 1
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def summary(self):
+        return ", ".join(f"{name}: {self.totals[name]:.2f}s" for name in self.stages if self.counts[name])
+
+    def write(self, path, **fields):
+        # Appends the totals of the epoch, together with fields such as the epoch number, as one JSON line
+        record = dict(fields)
+        record["stages"] = {name: round(self.totals[name], 6) for name in self.stages}
+        record["counts"] = dict(self.counts)
+
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + "\n")